@@ -0,0 +1,224 @@
+""" Benchmarks for dot sampling, trial creation and stimulus drawing.
+
+`run` times every benchmark and stores the results (and the versions and git
+commit they were obtained with) as a JSON baseline. `compare` compares two of
+those files and flags benchmarks whose median got slower than a threshold.
+
+By default, everything runs on the null window of `headless.py`, so that
+the suite runs without a display (draws then only measure the Python side of
+drawing). Use `--window screen` to time actual drawing.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import os.path as op
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+
+def summarize(durations):
+    durations = np.asarray(durations) * 1000.
+    return {'n': len(durations), 'mean_ms': durations.mean(), 'median_ms': np.median(durations),
+            'p95_ms': np.percentile(durations, 95), 'min_ms': durations.min()}
+
+
+def time_calls(func, n_repeats):
+    """ Returns the duration of `n_repeats` calls to `func` (in seconds). """
+    durations = np.zeros(n_repeats)
+
+    for ix in range(n_repeats):
+        start = time.perf_counter()
+        func()
+        durations[ix] = time.perf_counter() - start
+
+    return durations
+
+
+def get_metadata(window):
+    import pandas as pd
+    import psychopy
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=op.dirname(op.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': commit, 'window': window,
+            'machine': platform.node(), 'platform': platform.platform(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'psychopy': psychopy.__version__}
+
+
+def run_benchmarks(window='null', settings='default', n_repeats=50, n_frames=300):
+
+    if window == 'null':
+        # Has to be imported before the other experiment modules
+        from headless import HeadlessWTPSession as session_class
+    else:
+        from session import WTPSession as session_class
+
+    from benchmark_stimulus_array import time_draws
+    from utils import _sample_dot_positions, get_settings
+    import yaml
+
+    settings_fn, _ = get_settings(settings)
+    with open(settings_fn, 'r') as f:
+        settings_dict = yaml.safe_load(f)
+
+    aperture_radius = settings_dict['cloud']['aperture_radius']
+    dot_radius = settings_dict['cloud']['dot_radius']
+    payoffs = settings_dict['task']['payoffs']
+
+    results = {}
+    # Nothing draws from NumPy's global random state, so every input gets its own fixed seed
+    rng = np.random.default_rng(0)
+
+    for n_dots in payoffs:
+        results[f'sample_dot_positions[n_dots={n_dots}]'] = summarize(
+            time_calls(lambda: _sample_dot_positions(n_dots, aperture_radius, dot_radius, rng=rng), n_repeats * 10))
+
+    output_dir = tempfile.mkdtemp()
+
+    for slider_type in ['natural', 'log', 'two-stage', 'two-sliders']:
+        try:
+            session = session_class(output_str='benchmark', output_dir=output_dir, settings_file=settings_fn,
+                                    slider_type=slider_type, seed=0)
+        except Exception as e:
+            logging.warning(f'Skipping the {slider_type} benchmarks, could not set up a session: {e!r}')
+            continue
+
+        results[f'create_trials[{slider_type}]'] = summarize(time_calls(session.create_trials, n_repeats))
+
+        def construct_trials():
+            # Trials are constructed lazily, right before (or while the previous one is) running
+            for trial in session.trials:
+                if hasattr(trial, 'stimulus_array'):
+                    session.stimulus_array_pool.release(trial.stimulus_array)
+
+        results[f'construct_trials[{slider_type}]'] = summarize(time_calls(construct_trials, max(1, n_repeats // 10)))
+
+        stimuli = {}
+
+        if slider_type == 'natural':
+            session.response_slider.show_marker = True
+            stimuli['FixationLines'] = session.fixation_lines
+            stimuli['ResponseSlider'] = session.response_slider
+            stimuli['ProbabilityPieChart'] = session.stimulus_registry.get_pie_chart(
+                .55, settings_dict['prob_cue']['cue_size'])
+
+            for n_dots in payoffs:
+                stimuli[f'RadialStimArray[n_dots={n_dots}]'] = session.stimulus_array_pool.acquire(
+                    n_dots, rng=np.random.default_rng(n_dots))
+
+        elif slider_type == 'two-stage':
+            session.response_slider1.show_marker = True
+            stimuli['RangeResponseSlider'] = session.response_slider1
+        elif slider_type == 'two-sliders':
+            session.response_slider1.show_marker = True
+            stimuli['DiscreteResponseSlider'] = session.response_slider1
+
+        for name, stimulus in stimuli.items():
+            results[f'draw[{name}]'] = summarize(time_draws(session.win, stimulus, n_frames))
+
+        session.win.close()
+
+    return {'metadata': get_metadata(window), 'results': results}
+
+
+def compare(baseline, new, threshold=0.25):
+    """ Prints the change in median duration per benchmark and returns the benchmarks that regressed. """
+
+    regressions = []
+
+    print(f'{"benchmark":<45} {"baseline (ms)":>14} {"new (ms)":>10} {"change":>8}')
+
+    for name in sorted(set(baseline['results']) | set(new['results'])):
+        if name not in new['results']:
+            print(f'{name:<45} {"missing in new results":>34}')
+            continue
+        elif name not in baseline['results']:
+            print(f'{name:<45} {"not in baseline":>34}')
+            continue
+
+        old_median = baseline['results'][name]['median_ms']
+        new_median = new['results'][name]['median_ms']
+        change = new_median / old_median - 1.
+
+        flag = ''
+        if change > threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif change < -threshold:
+            flag = 'improved'
+
+        print(f'{name:<45} {old_median:>14.4f} {new_median:>10.4f} {change:>+8.1%} {flag}')
+
+    for label, results in [('baseline', baseline), ('new', new)]:
+        metadata = results['metadata']
+        print(f"{label}: commit {metadata['commit']}, {metadata['machine']}, {metadata['window']} window, "
+              f"{metadata['date']}")
+
+    if baseline['metadata']['machine'] != new['metadata']['machine']:
+        print('Warning: the results come from different machines')
+
+    print(f'{len(regressions)} regression(s) above {threshold:.0%}')
+
+    return regressions
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    subparsers = argparser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks and store the results')
+    run_parser.add_argument('--window', type=str, default='null', choices=['null', 'screen'],
+                            help='Null window (no display needed) or an actual window')
+    run_parser.add_argument('--settings', type=str, default='default', help='Settings label')
+    run_parser.add_argument('--n_repeats', type=int, default=50, help='Repetitions per (non-draw) benchmark')
+    run_parser.add_argument('--n_frames', type=int, default=300, help='Frames per draw benchmark')
+    run_parser.add_argument('--output', type=str, default=None,
+                            help='JSON file (default: benchmarks/<machine>_<window>.json)')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare results against a baseline')
+    compare_parser.add_argument('baseline', type=str, help='Baseline JSON file')
+    compare_parser.add_argument('new', type=str, help='JSON file with new results')
+    compare_parser.add_argument('--threshold', type=float, default=0.25,
+                                help='Relative slowdown of the median that counts as a regression')
+
+    args = argparser.parse_args()
+
+    if args.command == 'run':
+        results = run_benchmarks(window=args.window, settings=args.settings, n_repeats=args.n_repeats,
+                                 n_frames=args.n_frames)
+
+        output = args.output
+        if output is None:
+            output = op.join(op.dirname(op.abspath(__file__)), 'benchmarks',
+                             f"{results['metadata']['machine']}_{args.window}.json")
+
+        if op.dirname(output) and not op.isdir(op.dirname(output)):
+            os.makedirs(op.dirname(output))
+
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+        print(f'Wrote benchmark results to {output}')
+
+    else:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        with open(args.new, 'r') as f:
+            new = json.load(f)
+
+        if compare(baseline, new, threshold=args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
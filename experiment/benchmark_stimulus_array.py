@@ -0,0 +1,63 @@
+import argparse
+import numpy as np
+from psychopy import visual, monitors, core
+from utils import _sample_dot_positions, RadialStimArray
+
+
+class CircleStimArray(object):
+    """ The previous implementation: one Circle that is moved to, and drawn at, every position. """
+
+    def __init__(self, win, xys, sizes):
+        self.stimulus = visual.Circle(win, radius=sizes, edges=128, fillColor=[1, 1, 1])
+        self.xys = xys
+
+    def draw(self):
+        for pos in self.xys:
+            self.stimulus.pos = pos
+            self.stimulus.draw()
+
+
+def time_draws(win, stimulus, n_frames):
+    """ Returns the time spent in `draw()` for every frame (in seconds). """
+
+    durations = np.zeros(n_frames)
+
+    for frame in range(n_frames):
+        start = core.getTime()
+        stimulus.draw()
+        durations[frame] = core.getTime() - start
+        win.flip()
+
+    return durations
+
+
+def main(n_dots=(5, 9, 17, 30, 55, 100), n_frames=300, aperture_radius=2.5, dot_radius=.1):
+
+    mon = monitors.Monitor(name='benchmarkMonitor', width=30, distance=50)
+    win = visual.Window([1200, 1200], monitor=mon, units='deg', color=(0, 0, 0))
+
+    print(f'{"n_dots":>6} {"circles (ms)":>16} {"element array (ms)":>20} {"speedup":>8}')
+
+    for n in n_dots:
+        xys = _sample_dot_positions(n, aperture_radius, dot_radius)
+
+        circles = time_draws(win, CircleStimArray(win, xys, dot_radius), n_frames)
+        elements = time_draws(win, RadialStimArray(win, xys, dot_radius), n_frames)
+
+        print(f'{n:>6} {np.median(circles)*1e3:>8.3f} ({np.percentile(circles, 95)*1e3:.3f}) '
+              f'{np.median(elements)*1e3:>12.3f} ({np.percentile(elements, 95)*1e3:.3f}) '
+              f'{np.median(circles) / np.median(elements):>7.1f}x')
+
+    print('Median (95th percentile) time per frame spent in draw().')
+
+    win.close()
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--n_frames', type=int, help='Number of frames per condition', default=300)
+    argparser.add_argument('--n_dots', type=int, nargs='+', help='Dot counts', default=[5, 9, 17, 30, 55, 100])
+
+    args = argparser.parse_args()
+
+    main(n_dots=args.n_dots, n_frames=args.n_frames)
@@ -0,0 +1,269 @@
+""" Optimizes the order of trials and the assignment of ISIs for fMRI design efficiency.
+
+Candidate designs keep the structure of `WTPSession.create_trials`: one block
+per probability (in random order, each preceded by a probability cue), the
+payoffs in random order within every block, and the ISIs of `durations.isi`
+(repeated up to `n_trials`) distributed over the trials. Every candidate is
+scored by how well its design matrix separates the responses to the payoff
+levels: the stimulus regressors of all payoffs (plus response and cue
+regressors) are convolved with a canonical HRF, and the efficiency is
+1 / trace(C (X'X)^-1 C') for the contrasts between successive payoffs.
+Candidates are generated and scored in batches (NumPy, no Python loop per
+candidate) in several processes.
+
+    python design.py 1 2 3 --n_runs 4 --n_candidates 20000
+
+writes the best design for every subject and run to
+`designs/sub-<subject>_run-<run>_design.tsv`.
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import os.path as op
+import numpy as np
+import pandas as pd
+import yaml
+
+# Candidates are split into this many chunks (each with its own seed), whatever the number of processes,
+# so that the same seed always gives the same design
+N_CHUNKS = 64
+
+
+def get_design_parameters(settings):
+    """ Everything about the task that matters for its design. """
+    task = settings['task']
+    durations = settings['durations']
+
+    probs = np.array(task['probabilities'])
+    payoffs = np.array(task['payoffs'])
+    n_trials = task['n_trials']
+
+    # Same rules as WTPSession.create_trials
+    if n_trials % len(probs) != 0:
+        raise ValueError('n_trials should be a multiple of n_probs')
+    if n_trials % len(payoffs) != 0:
+        raise ValueError('n_trials should be a multiple of n_payoffs')
+
+    isis = durations['isi'] * int(np.ceil(n_trials / len(durations['isi'])))
+
+    return {'probs': probs, 'payoffs': payoffs, 'n_trials': n_trials,
+            'isis': np.array(isis[:n_trials], dtype=float),
+            'tr': settings['mri']['TR'],
+            'cue_duration': durations.get('cue_trials', 2.),
+            'stimulus_offset': durations['first_fixation'] + durations['second_fixation'],
+            'stimulus_duration': durations['array_duration'],
+            'response_duration': durations['response_screen'],
+            'feedback_duration': durations['feedback']}
+
+
+def sample_designs(params, n, rng):
+    """ `n` random designs: the order of the probability blocks and the payoff and ISI of every trial. """
+    n_probs = len(params['probs'])
+    n_per_block = params['n_trials'] // n_probs
+
+    prob_order = np.argsort(rng.random((n, n_probs)), axis=1)
+
+    # Every block shows the payoffs in a random order (repeated if a block has more trials)
+    block_payoffs = np.resize(np.arange(len(params['payoffs'])), n_per_block)
+    shuffles = np.argsort(rng.random((n, n_probs, n_per_block)), axis=2)
+    payoff_ix = block_payoffs[shuffles].reshape(n, params['n_trials'])
+
+    isi_order = np.argsort(rng.random((n, params['n_trials'])), axis=1)
+    isis = params['isis'][isi_order]
+
+    return prob_order, payoff_ix, isis
+
+
+def get_onsets(params, isis):
+    """ Onsets (relative to the first probability cue) of the cues, stimuli and response screens. """
+    n, n_trials = isis.shape
+    n_probs = len(params['probs'])
+    n_per_block = n_trials // n_probs
+
+    trial_durations = (params['stimulus_offset'] + params['stimulus_duration'] + isis +
+                       params['response_duration'] + params['feedback_duration'])
+
+    # Every block starts with a probability cue
+    block_start = (np.arange(n_trials) % n_per_block) == 0
+    durations = trial_durations + block_start * params['cue_duration']
+    trial_onsets = np.cumsum(durations, axis=1) - trial_durations
+
+    cue_onsets = trial_onsets[:, block_start] - params['cue_duration']
+    stimulus_onsets = trial_onsets + params['stimulus_offset']
+    response_onsets = stimulus_onsets + params['stimulus_duration'] + isis
+
+    return cue_onsets, stimulus_onsets, response_onsets, trial_onsets[:, -1] + trial_durations[:, -1]
+
+
+def canonical_hrf(dt, length=32.):
+    """ SPM's double-gamma HRF (peak at 6 s, undershoot at 16 s), sampled every `dt` s. """
+    t = np.arange(0, length, dt)
+    peak = t**5 * np.exp(-t) / math.gamma(6)
+    undershoot = t**15 * np.exp(-t) / math.gamma(16)
+    hrf = peak - undershoot / 6.
+    return hrf / hrf.sum()
+
+
+def design_matrices(params, payoff_ix, isis, dt=.1):
+    """ Design matrices (n, n_volumes, n_payoffs + 3) of a batch of designs.
+
+    Columns: one stimulus regressor per payoff, the response screens, the
+    probability cues and the intercept.
+    """
+    n, n_trials = payoff_ix.shape
+    n_payoffs = len(params['payoffs'])
+
+    cue_onsets, stimulus_onsets, response_onsets, run_durations = get_onsets(params, isis)
+
+    n_volumes = int(np.ceil(run_durations.max() / params['tr'])) + int(np.ceil(20. / params['tr']))
+    n_samples = int(np.round(n_volumes * params['tr'] / dt))
+
+    # Boxcars at a resolution of dt, built from +1/-1 steps at the onsets and offsets
+    steps = np.zeros((n, n_payoffs + 2, n_samples + 1))
+    rows = np.repeat(np.arange(n), n_trials)
+
+    def add_boxcars(rows, columns, onsets, duration):
+        start = np.round(onsets / dt).astype(int).ravel()
+        end = np.round((onsets + duration) / dt).astype(int).ravel()
+        np.add.at(steps, (rows, columns, np.minimum(start, n_samples)), 1.)
+        np.add.at(steps, (rows, columns, np.minimum(end, n_samples)), -1.)
+
+    add_boxcars(rows, payoff_ix.ravel(), stimulus_onsets, params['stimulus_duration'])
+    add_boxcars(rows, n_payoffs, response_onsets, params['response_duration'])
+    add_boxcars(np.repeat(np.arange(n), cue_onsets.shape[1]), n_payoffs + 1, cue_onsets, params['cue_duration'])
+
+    boxcars = np.cumsum(steps, axis=2)[..., :n_samples]
+
+    # Batched convolution with the HRF (through the FFT)
+    hrf = canonical_hrf(dt)
+    n_fft = 1 << int(np.ceil(np.log2(n_samples + len(hrf))))
+    convolved = np.fft.irfft(np.fft.rfft(boxcars, n_fft, axis=2) * np.fft.rfft(hrf, n_fft), n_fft,
+                             axis=2)[..., :n_samples]
+
+    # Sampled at the middle of every volume
+    volume_samples = np.round((np.arange(n_volumes) + .5) * params['tr'] / dt).astype(int)
+    X = convolved[..., volume_samples].transpose(0, 2, 1)
+
+    return np.concatenate((X, np.ones((n, n_volumes, 1))), axis=2)
+
+
+def payoff_contrasts(n_payoffs, n_columns):
+    """ Differences between successive payoffs. """
+    contrasts = np.zeros((n_payoffs - 1, n_columns))
+    contrasts[:, :n_payoffs - 1] -= np.eye(n_payoffs - 1)
+    contrasts[:, 1:n_payoffs] += np.eye(n_payoffs - 1)
+    return contrasts
+
+
+def efficiency(X, contrasts):
+    """ 1 / trace(C (X'X)^-1 C') of every design matrix in `X` (n, n_volumes, n_columns). """
+    XtX = np.einsum('nvi,nvj->nij', X, X)
+    inv_XtX = np.linalg.pinv(XtX, hermitian=True)
+    return 1. / np.einsum('ci,nij,cj->n', contrasts, inv_XtX, contrasts)
+
+
+def _score_batch(args):
+    """ Samples and scores a batch of designs (in a worker process) and returns the best one. """
+    params, n, seed_sequence, batch_size = args
+    rng = np.random.default_rng(seed_sequence)
+
+    best, best_efficiency, efficiencies = None, -np.inf, []
+
+    for start in range(0, n, batch_size):
+        prob_order, payoff_ix, isis = sample_designs(params, min(batch_size, n - start), rng)
+        X = design_matrices(params, payoff_ix, isis)
+        batch_efficiency = efficiency(X, payoff_contrasts(len(params['payoffs']), X.shape[2]))
+
+        ix = np.argmax(batch_efficiency)
+        if batch_efficiency[ix] > best_efficiency:
+            best = (prob_order[ix], payoff_ix[ix], isis[ix])
+            best_efficiency = batch_efficiency[ix]
+
+        efficiencies.append(batch_efficiency)
+
+    return best, best_efficiency, np.concatenate(efficiencies)
+
+
+def optimize_design(params, n_candidates=10000, seed_sequence=None, pool=None, batch_size=100,
+                    n_chunks=N_CHUNKS):
+    """ Best of `n_candidates` random designs, as a table with one row per trial.
+
+    The candidates are scored in `n_chunks` chunks, spread over the processes
+    of `pool`. The result only depends on `seed_sequence` and `n_chunks`.
+    """
+    if seed_sequence is None:
+        seed_sequence = np.random.SeedSequence()
+
+    chunk_sizes = [len(chunk) for chunk in np.array_split(np.arange(n_candidates), n_chunks)]
+    jobs = [(params, size, seq, batch_size) for size, seq in zip(chunk_sizes, seed_sequence.spawn(n_chunks))
+            if size > 0]
+
+    results = pool.map(_score_batch, jobs) if pool is not None else list(map(_score_batch, jobs))
+
+    # Ties go to the first chunk
+    best_ix = max(range(len(results)), key=lambda ix: (results[ix][1], -ix))
+    (prob_order, payoff_ix, isis), best_efficiency, _ = results[best_ix]
+    all_efficiencies = np.concatenate([result[2] for result in results])
+
+    n_per_block = params['n_trials'] // len(params['probs'])
+    _, stimulus_onsets, _, _ = get_onsets(params, isis[np.newaxis, :])
+
+    design = pd.DataFrame({'trial_nr': np.arange(1, params['n_trials'] + 1),
+                           'prob': np.repeat(params['probs'][prob_order], n_per_block),
+                           'payoff': params['payoffs'][payoff_ix],
+                           'jitter': isis,
+                           'stimulus_onset': stimulus_onsets[0].round(3)})
+
+    return design, best_efficiency, all_efficiencies
+
+
+def main(subjects, n_runs=None, settings='default', n_candidates=10000, seed=0, n_processes=None, output_dir=None):
+
+    settings_fn = op.join(op.dirname(__file__), 'settings', f'{settings}.yml')
+
+    with open(settings_fn, 'r') as f:
+        settings = yaml.safe_load(f)
+
+    params = get_design_parameters(settings)
+
+    if n_runs is None:
+        n_runs = settings.get('main', {}).get('n_runs', 1)
+
+    if output_dir is None:
+        output_dir = op.join(op.dirname(__file__), 'designs')
+
+    if not op.exists(output_dir):
+        os.makedirs(output_dir)
+
+    n_processes = n_processes or os.cpu_count() or 1
+
+    with multiprocessing.Pool(n_processes) as pool:
+        for subject in subjects:
+            for run in range(1, n_runs + 1):
+                # The same subject, run and seed always give the same design
+                seed_sequence = np.random.SeedSequence([seed, run] + list(str(subject).encode()))
+                design, best_efficiency, efficiencies = optimize_design(params, n_candidates=n_candidates,
+                                                                        seed_sequence=seed_sequence, pool=pool)
+
+                fn = op.join(output_dir, f'sub-{subject}_run-{run}_design.tsv')
+                design.to_csv(fn, sep='\t', index=False)
+
+                print(f'sub-{subject} run-{run}: efficiency {best_efficiency:.4g} (median of {len(efficiencies)} '
+                      f'candidates: {np.median(efficiencies):.4g}), written to {fn}')
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('subjects', type=str, nargs='+', help='Subject nrs')
+    argparser.add_argument('--n_runs', type=int, default=None, help='Number of runs (default: main.n_runs or 1)')
+    argparser.add_argument('--settings', type=str, help='Settings label', default='default')
+    argparser.add_argument('--n_candidates', type=int, default=10000, help='Candidate designs per subject and run')
+    argparser.add_argument('--n_processes', type=int, default=None, help='Worker processes (default: all cores)')
+    argparser.add_argument('--seed', type=int, help='Random seed', default=0)
+    argparser.add_argument('--output_dir', type=str, default=None, help='Output directory (default: designs/)')
+
+    args = argparser.parse_args()
+
+    main(args.subjects, n_runs=args.n_runs, settings=args.settings, n_candidates=args.n_candidates,
+         seed=args.seed, n_processes=args.n_processes, output_dir=args.output_dir)
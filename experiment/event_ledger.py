@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+
+
+class EventLedger(object):
+    """ Session log of phase onsets and key events in preallocated NumPy columns.
+
+    Replaces appending to exptools2's `global_log` DataFrame (which gets
+    slower as the log grows) while the experiment runs. Appending a row and
+    looking up the onset of the current phase take constant time. The
+    ledger is only turned into the `global_log` DataFrame when the session
+    closes (see `to_dataframe()`).
+    """
+
+    columns = ['trial_nr', 'onset', 'event_type', 'phase', 'response', 'nr_frames']
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.n_events = 0
+
+        self.trial_nr = np.zeros(capacity, dtype=np.int32)
+        self.onset = np.zeros(capacity)
+        self.phase = np.zeros(capacity, dtype=np.int16)
+        self.nr_frames = np.full(capacity, np.nan)
+
+        # Event types are stored as indices into `event_types`
+        self.event_type = np.zeros(capacity, dtype=np.int16)
+        self.event_types = []
+        self._event_type_codes = {}
+
+        # Keys and trial parameters are not numeric, so they are kept per row
+        self.response = np.full(capacity, None, dtype=object)
+        self.parameters = np.full(capacity, None, dtype=object)
+
+        # Onset of the phase that is currently on screen
+        self.phase_onset = np.nan
+
+        # Optionally, every event is also streamed to disk (see `event_stream.py`)
+        self.stream = None
+
+    def __len__(self):
+        return self.n_events
+
+    def _grow(self):
+        for name in ['trial_nr', 'onset', 'phase', 'nr_frames', 'event_type', 'response', 'parameters']:
+            column = getattr(self, name)
+            new_column = np.empty(2 * self.capacity, dtype=column.dtype)
+            new_column[:self.capacity] = column
+            setattr(self, name, new_column)
+
+        self.capacity *= 2
+
+    def _append(self, trial_nr, onset, event_type, phase, nr_frames=np.nan, response=None, parameters=None):
+        if self.n_events == self.capacity:
+            self._grow()
+
+        if event_type not in self._event_type_codes:
+            self._event_type_codes[event_type] = len(self.event_types)
+            self.event_types.append(event_type)
+
+        ix = self.n_events
+        self.trial_nr[ix] = trial_nr
+        self.onset[ix] = onset
+        self.event_type[ix] = self._event_type_codes[event_type]
+        self.phase[ix] = phase
+        self.nr_frames[ix] = nr_frames
+        self.response[ix] = response
+        # Parameters change while the trial runs, so every row gets the values it was logged with
+        self.parameters[ix] = dict(parameters) if parameters else None
+
+        self.n_events += 1
+
+        if self.stream is not None:
+            self.stream.write({'trial_nr': trial_nr, 'onset': onset, 'event_type': event_type, 'phase': phase,
+                               'nr_frames': nr_frames, 'response': response, 'parameters': self.parameters[ix]})
+
+    def log_phase(self, trial_nr, onset, event_type, phase, nr_frames, parameters=None):
+        self._append(trial_nr, onset, event_type, phase, nr_frames=nr_frames, parameters=parameters)
+        self.phase_onset = onset
+
+    def log_key(self, trial_nr, onset, event_type, phase, key, parameters=None):
+        self._append(trial_nr, onset, event_type, phase, response=key, parameters=parameters)
+
+    @classmethod
+    def from_events(cls, events):
+        """ Ledger with `events` (dicts as streamed by the ledger). """
+        ledger = cls(capacity=max(len(events), 1))
+
+        for e in events:
+            ledger._append(e['trial_nr'], e['onset'], e['event_type'], e['phase'], nr_frames=e['nr_frames'],
+                           response=e['response'], parameters=e['parameters'])
+
+        return ledger
+
+    def to_dataframe(self):
+        """ The ledger in the format of exptools2's `global_log`. """
+        n = self.n_events
+
+        log = pd.DataFrame({'trial_nr': self.trial_nr[:n],
+                            'onset': self.onset[:n],
+                            'event_type': np.array(self.event_types, dtype=object)[self.event_type[:n]] if n else [],
+                            'phase': self.phase[:n],
+                            'response': self.response[:n],
+                            'nr_frames': self.nr_frames[:n]}, columns=self.columns)
+
+        parameters = pd.DataFrame.from_records([p if p is not None else {} for p in self.parameters[:n]],
+                                               index=log.index)
+
+        # As in exptools2, parameters with the name of a log column (e.g., 'response') take its place
+        for column in parameters.columns.intersection(self.columns):
+            log[column] = parameters.pop(column).where(lambda values: values.notnull(), log[column])
+
+        return pd.concat([log, parameters], axis=1)
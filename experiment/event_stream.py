@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import os.path as op
+import queue
+import threading
+import numpy as np
+
+
+def _to_json(value):
+    # NumPy scalars (e.g., trial parameters) are not serializable as such
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+class EventStreamWriter(object):
+    """ Appends logged events to a line-delimited JSON file in a background thread.
+
+    The render thread only puts events on a queue; the writer thread
+    serializes and writes them, and flushes and fsyncs the file whenever
+    `sync()` is called (at the end of every trial). After a crash, the
+    events file can be rebuilt from the stream with `recover_log.py`.
+
+    The first line is a header with the session's output string, the start
+    of the experiment (`exp_start`) and the date.
+    """
+
+    # Queued instead of events, to make the writer thread fsync or stop
+    _sync = object()
+    _stop = object()
+
+    def __init__(self, fn, header=None):
+        self.fn = fn
+        self.header = {} if header is None else header
+        self.n_events = 0
+
+        self._queue = queue.Queue()
+        self._thread = None
+
+    @property
+    def running(self):
+        return (self._thread is not None) and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+
+        self._thread = threading.Thread(target=self._run, name='EventStreamWriter', daemon=True)
+        self._thread.start()
+
+    def write(self, event):
+        self._queue.put(event)
+        self.n_events += 1
+
+    def sync(self):
+        """ Makes the writer thread flush everything written so far to disk. """
+        self._queue.put(self._sync)
+
+    def stop(self):
+        if self.running:
+            self._queue.put(self._stop)
+            self._thread.join()
+
+    def _run(self):
+        if not op.isdir(op.dirname(self.fn)):
+            os.makedirs(op.dirname(self.fn))
+
+        with open(self.fn, 'w') as f:
+            f.write(json.dumps(dict(self.header, type='header'), default=_to_json) + '\n')
+
+            while True:
+                item = self._queue.get()
+
+                if item is self._sync or item is self._stop:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                    if item is self._stop:
+                        break
+                else:
+                    try:
+                        f.write(json.dumps(item, default=_to_json) + '\n')
+                    except (TypeError, ValueError) as e:
+                        logging.warning(f'Could not stream event {item!r}: {e}')
+
+
+def read_stream(fn):
+    """ Returns the header and the events of an event stream.
+
+    A truncated last line (the writer was killed while writing it) is skipped.
+    """
+    header = {}
+    events = []
+
+    with open(fn, 'r') as f:
+        lines = f.readlines()
+
+    for ix, line in enumerate(lines):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            if ix == len(lines) - 1:
+                logging.warning(f'Skipping the incomplete last line of {fn}')
+                continue
+            raise
+
+        if record.get('type') == 'header':
+            header = record
+        else:
+            events.append(record)
+
+    return header, events
@@ -0,0 +1,226 @@
+import functools
+import logging
+import threading
+import time
+import numpy as np
+
+
+class LockedTracker(object):
+    """ Stands in for a pylink tracker, and calls its methods while holding `lock`.
+
+    pylink is not thread-safe, and the gaze sampler polls the tracker from
+    its own thread while the session (and exptools2, e.g. the status message
+    at the start of every trial) sends it commands and messages from the
+    main thread. The lock is reentrant, so calls back into the tracker (e.g.
+    during calibration) do not block.
+    """
+
+    def __init__(self, tracker, lock=None):
+        self._tracker = tracker
+        self._lock = threading.RLock() if lock is None else lock
+
+    def __getattr__(self, name):
+        attribute = getattr(self._tracker, name)
+
+        if not callable(attribute):
+            return attribute
+
+        @functools.wraps(attribute)
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attribute(*args, **kwargs)
+
+        return locked
+
+
+class EyeLinkGazeSource(object):
+    """ Newest gaze sample of an EyeLink (through pylink), in degrees relative to the center of the window.
+
+    The tracker is polled from the gaze sampler's thread, so it should be a
+    `LockedTracker` that every other call to the tracker goes through too.
+    """
+
+    def __init__(self, tracker, win):
+        from psychopy.tools.monitorunittools import pix2deg
+        import pylink
+
+        self.tracker = tracker
+        self.monitor = win.monitor
+        self.size = np.array(win.size)
+        self.pix2deg = pix2deg
+        self.missing = pylink.MISSING_DATA
+        self.last_sample_time = None
+
+    def get_gaze(self):
+        """ (x, y) of the newest sample (NaN during blinks), or None if there is no new sample. """
+        sample = self.tracker.getNewestSample()
+
+        if (sample is None) or (sample.getTime() == self.last_sample_time):
+            return None
+
+        self.last_sample_time = sample.getTime()
+
+        if sample.isRightSample():
+            x, y = sample.getRightEye().getGaze()
+        elif sample.isLeftSample():
+            x, y = sample.getLeftEye().getGaze()
+        else:
+            return np.array([np.nan, np.nan])
+
+        if (x == self.missing) or (y == self.missing):
+            return np.array([np.nan, np.nan])
+
+        # EyeLink screen coordinates start at the top left
+        pos = np.array([x - self.size[0] / 2., self.size[1] / 2. - y])
+        return self.pix2deg(pos, self.monitor)
+
+
+class SimulatedGazeSource(object):
+    """ Fixation with Gaussian noise, interrupted by saccades away from fixation (at random times). """
+
+    def __init__(self, clock, noise=.1, break_rate=.05, break_duration=.4, break_amplitude=4., seed=None):
+        self.clock = clock
+        self.noise = noise
+        self.break_rate = break_rate
+        self.break_duration = break_duration
+        self.break_amplitude = break_amplitude
+        self.rng = np.random.default_rng(seed)
+
+        self.break_onset = None
+        self.break_pos = None
+        self._schedule_break(0.0)
+
+    def _schedule_break(self, t):
+        if self.break_rate > 0:
+            self.break_onset = t + self.rng.exponential(1. / self.break_rate)
+            angle = self.rng.uniform(0, 2 * np.pi)
+            self.break_pos = self.break_amplitude * np.array([np.cos(angle), np.sin(angle)])
+        else:
+            self.break_onset = np.inf
+
+    def get_gaze(self):
+        t = self.clock.getTime()
+
+        while t >= self.break_onset + self.break_duration:
+            self._schedule_break(self.break_onset + self.break_duration)
+
+        pos = self.rng.normal(0.0, self.noise, 2)
+
+        if t >= self.break_onset:
+            pos += self.break_pos
+
+        return pos
+
+
+class GazeSampler(object):
+    """ Pulls gaze samples into a ring buffer in a background thread, at the tracker's sampling rate.
+
+    Every sample is checked against a circular fixation window, and the
+    time of the last sample outside it (or missing, e.g. during a blink) is
+    kept. Whether fixation is stable (`is_fixating()`) or was broken since a
+    given time (`broken_since()`) can then be checked in constant time.
+    Without a sample in the last `max_age` seconds, there is no fixation.
+    """
+
+    def __init__(self, source, clock, rate=500., radius=1.5, center=(0.0, 0.0), max_age=.1, buffer_size=2**16):
+        self.source = source
+        self.clock = clock
+        self.period = 1. / rate
+        self.radius = radius
+        self.max_age = max_age
+        self.center = np.array(center)
+        self.buffer_size = buffer_size
+
+        self.times = np.zeros(buffer_size)
+        self.positions = np.zeros((buffer_size, 2))
+        self.n_samples = 0
+
+        # Session time of the last sample that was not within the fixation window
+        self.last_outside = -np.inf
+        self.first_sample = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return (self._thread is not None) and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='GazeSampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+
+    def _run(self):
+        next_sample = time.perf_counter()
+
+        while not self._stop.is_set():
+            try:
+                self._sample()
+            except Exception as e:
+                logging.warning(f'Could not get a gaze sample: {e!r}')
+
+            next_sample += self.period
+            delay = next_sample - time.perf_counter()
+
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_sample = time.perf_counter()
+
+    def _sample(self):
+        pos = self.source.get_gaze()
+
+        if pos is None:
+            return
+
+        t = self.clock.getTime()
+        ix = self.n_samples % self.buffer_size
+        self.positions[ix] = pos
+        self.times[ix] = t
+
+        # NaN (missing) positions count as outside
+        if not (np.sum((pos - self.center)**2) <= self.radius**2):
+            self.last_outside = t
+
+        if self.first_sample is None:
+            self.first_sample = t
+
+        self.n_samples += 1
+
+    def latest(self):
+        """ Time and position of the newest sample (None if there is none yet). """
+        n_samples = self.n_samples
+
+        if n_samples == 0:
+            return None
+
+        ix = (n_samples - 1) % self.buffer_size
+        return self.times[ix], self.positions[ix].copy()
+
+    def is_fixating(self, duration):
+        """ Whether all samples of the last `duration` seconds were within the fixation window. """
+        latest = self.latest()
+
+        if latest is None:
+            return False
+
+        now = self.clock.getTime()
+
+        # The tracker stopped sending samples (or the sampler stalled)
+        if now - latest[0] > self.max_age:
+            return False
+
+        return (now - max(self.last_outside, self.first_sample)) >= duration
+
+    def broken_since(self, t):
+        """ Whether there were samples outside the fixation window since `t`. """
+        return self.last_outside >= t
@@ -0,0 +1,638 @@
+""" Runs complete sessions without a display, in simulated time.
+
+Stimuli are replaced by null stimuli that keep their attributes but draw
+nothing, the window only advances a simulated clock by one refresh period per
+flip, and mouse, keyboard and scanner pulses come from a simulated
+participant and scanner. A whole run takes seconds and writes the same log
+files as a real one.
+
+This module patches PsychoPy when it is imported, so it has to be imported
+before any of the other experiment modules (and exptools2).
+"""
+import argparse
+import sys
+import time
+import pyglet
+
+# Allows importing psychopy.visual without a display
+pyglet.options['shadow_window'] = False
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from psychopy import visual, event, monitors
+
+
+class SimulatedTime(object):
+    """ The simulated 'now' (in seconds) that all simulated clocks of a session share. """
+
+    def __init__(self):
+        self.now = 0.0
+
+
+class SimulatedClock(object):
+    """ Drop-in replacement for `psychopy.core.Clock` that runs on simulated time. """
+
+    def __init__(self, simulated_time):
+        self.simulated_time = simulated_time
+        self._time_at_last_reset = simulated_time.now
+
+    def getTime(self, applyZero=True):
+        return self.simulated_time.now - self._time_at_last_reset
+
+    def getLastResetTime(self):
+        return self._time_at_last_reset
+
+    def reset(self, newT=0.0):
+        self._time_at_last_reset = self.simulated_time.now + newT
+
+    def add(self, t):
+        self._time_at_last_reset += t
+
+    def addTime(self, t):
+        self.add(t)
+
+
+class NullWindow(object):
+    """ Window that draws nothing; every flip advances simulated time by one refresh period. """
+
+    def __init__(self, simulated_time, size=(1200, 1200), units='deg', monitor=None, frame_rate=60.,
+                 colorSpace='rgb', color=(0, 0, 0), max_duration=3600., **kwargs):
+
+        self.simulated_time = simulated_time
+        self.size = np.array(size)
+        self.units = units
+        self.colorSpace = colorSpace
+        self.color = color
+        self.useRetina = False
+        self.mouseVisible = False
+        self.autoLog = False
+
+        if not isinstance(monitor, monitors.Monitor):
+            monitor = monitors.Monitor(**dict({'name': 'headless', 'width': 30, 'distance': 50}, **(monitor or {})))
+        monitor.setSizePix(list(size))
+        self.monitor = monitor
+
+        self.monitorFramePeriod = 1. / frame_rate
+        self.max_duration = max_duration
+
+        self.recordFrameIntervals = False
+        self.frameIntervals = []
+        self.nDroppedFrames = 0
+        self.frames = 0
+        self.lastFrameT = simulated_time.now
+        self._to_call = []
+        # Take their samples during the frame (see SimulatedMouseSampler)
+        self.samplers = []
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._to_call.append((function, args, kwargs))
+
+    def flip(self, clearBuffer=True):
+        frame_end = self.simulated_time.now + self.monitorFramePeriod
+
+        for sampler in self.samplers:
+            sampler.advance(frame_end)
+
+        self.simulated_time.now = frame_end
+
+        if self.simulated_time.now > self.max_duration:
+            raise RuntimeError(f'Simulated session did not finish within {self.max_duration:.0f} s')
+
+        to_call, self._to_call = self._to_call, []
+        for function, args, kwargs in to_call:
+            function(*args, **kwargs)
+
+        # As in PsychoPy, the interval is recorded after the flip callbacks have run
+        if self.recordFrameIntervals:
+            self.frameIntervals.append(self.simulated_time.now - self.lastFrameT)
+
+        self.lastFrameT = self.simulated_time.now
+        self.frames += 1
+
+        return self.simulated_time.now
+
+    def getActualFrameRate(self, *args, **kwargs):
+        return 1. / self.monitorFramePeriod
+
+    def setMouseVisible(self, visible):
+        self.mouseVisible = visible
+
+    def clearBuffer(self, *args, **kwargs):
+        pass
+
+    def _getRegionOfFrame(self, rect=(-1, 1, 1, -1), *args, **kwargs):
+        # An empty image of the size of the (norm) rectangle
+        left, top, right, bottom = rect
+        size = np.round(np.abs([right - left, top - bottom]) * self.size / 2.).astype(int)
+        return Image.new('RGBA', tuple(size))
+
+    def close(self):
+        pass
+
+
+class NullStim(object):
+    """ Stands in for any PsychoPy stimulus: keeps the attributes it is given, but draws nothing. """
+
+    def __init__(self, win=None, *args, **kwargs):
+        self.win = win
+        self.pos = (0.0, 0.0)
+        self.boundingBox = (0, 0)
+        self.__dict__.update(kwargs)
+
+    def draw(self, *args, **kwargs):
+        pass
+
+    def clearTextures(self):
+        pass
+
+    def __getattr__(self, name):
+        # setColor(), setPos(), ... just set the attribute
+        if name.startswith('set') and len(name) > 3:
+            attribute = name[3].lower() + name[4:]
+            return lambda value, *args, **kwargs: setattr(self, attribute, value)
+        raise AttributeError(name)
+
+
+class SimulatedParticipant(object):
+    """ Reports the payoff of every trial with log-normal noise, after a normally distributed response time.
+
+    The estimate is sampled once per trial and given in both response stages
+    (each with its own response time). Trials are missed with probability `p_miss`.
+    """
+
+    def __init__(self, noise=.2, rt_mean=1.5, rt_sd=.4, min_rt=.6, p_miss=0.0, instruction_rt=1.5,
+                 outro_duration=2.0, seed=None):
+        self.noise = noise
+        self.rt_mean = rt_mean
+        self.rt_sd = rt_sd
+        self.min_rt = min_rt
+        self.p_miss = p_miss
+        self.instruction_rt = instruction_rt
+        self.outro_duration = outro_duration
+        # Does not touch the global random state, which the trials seed
+        self.rng = np.random.RandomState(seed)
+
+    def plan(self, trial):
+        """ (value, response time) for every response stage of `trial` (a response time of None: no response). """
+        n_stages = 2 if hasattr(trial, 'response_phase1') else 1
+
+        if self.rng.rand() < self.p_miss:
+            return [(None, None)] * n_stages
+
+        estimate = trial.parameters['payoff'] * np.exp(self.rng.randn() * self.noise)
+        rts = np.maximum(self.min_rt, self.rng.normal(self.rt_mean, self.rt_sd, n_stages))
+
+        return [(estimate, rt) for rt in rts]
+
+
+class ScriptedParticipant(SimulatedParticipant):
+    """ Gives the responses (and response times) of a table, e.g., to replay a logged session. """
+
+    def __init__(self, responses, **kwargs):
+        super().__init__(**kwargs)
+        self.responses = responses
+
+    @classmethod
+    def from_events(cls, fn, **kwargs):
+        """ Reads the responses from an `_events.tsv` file written by a (real or simulated) session. """
+        events = pd.read_csv(fn, sep='\t')
+
+        # Key presses are logged in the response column as well
+        if 'event_type' in events.columns:
+            events = events[~events['event_type'].isin(['response', 'pulse'])]
+
+        columns = ['response1', 'response_time1', 'response', 'response_time2', 'response_time']
+        events = events[[c for c in ['trial_nr'] + columns if c in events.columns]]
+        responses = events.groupby('trial_nr').last().reindex(columns=columns).apply(pd.to_numeric, errors='coerce')
+
+        return cls(responses, **kwargs)
+
+    def plan(self, trial):
+        if hasattr(trial, 'response_phase1'):
+            stages = [('response1', 'response_time1'), ('response', 'response_time2')]
+        else:
+            stages = [('response', 'response_time')]
+
+        if trial.trial_nr not in self.responses.index:
+            return [(None, None)] * len(stages)
+
+        row = self.responses.loc[trial.trial_nr]
+        plan = []
+
+        for value, rt in [(row[value], row[rt]) for value, rt in stages]:
+            if pd.isnull(value) or pd.isnull(rt):
+                plan.append((None, None))
+            else:
+                plan.append((value, rt))
+
+        return plan
+
+
+class SimulatedInput(object):
+    """ Keyboard, mouse and scanner pulses of a simulated participant and scanner.
+
+    Whenever the input is polled, it checks which trial and phase are on
+    screen and plans the participant's actions for them: key presses to
+    leave instruction screens, pulses every TR once the scanner is waited
+    for, and mouse movements (with a minimum-jerk profile) and clicks in the
+    response phases.
+    """
+
+    def __init__(self, session, participant, scripted_keys=None):
+        self.session = session
+        self.participant = participant
+
+        self.sync_key = session.settings['mri'].get('sync', 't')
+        self.mouse_multiplier = session.settings['interface']['mouse_multiplier']
+
+        # (session time, key), on the session clock
+        self.keys = sorted(scripted_keys or [], key=lambda k: k[0])
+        self.last_poll = 0.0
+
+        self.mouse_pos = np.zeros(2)
+        self.movement = None
+        self.click_time = None
+
+        self.state = None
+        self.trial_plan = None
+
+    def _now(self):
+        return self.session.clock.getTime()
+
+    def _poll(self):
+        now = self._now()
+
+        # The scanner sends its pulses as the sync key
+        for t in self.session.trigger_source.pulses_between(self.last_poll, now):
+            self._press(t, self.sync_key)
+        self.last_poll = now
+
+        trial = getattr(self.session, 'current_trial', None)
+
+        if (trial is None) or (self.state == (id(trial), trial.phase)):
+            return
+
+        new_trial = (self.state is None) or (self.state[0] != id(trial))
+        self.state = (id(trial), trial.phase)
+        self.movement = None
+        self.click_time = None
+
+        from instruction import InstructionTrial, DummyWaiterTrial, OutroTrial
+
+        if isinstance(trial, DummyWaiterTrial):
+            self.session.trigger_source.start(now)
+        elif isinstance(trial, OutroTrial):
+            if new_trial:
+                self._press(now + self.participant.outro_duration, 'space')
+        elif type(trial) is InstructionTrial:
+            if new_trial:
+                self._press(now + self.participant.instruction_rt, 'space')
+        elif hasattr(trial, 'response_phase'):
+            if new_trial:
+                self.trial_plan = self.participant.plan(trial)
+
+            if hasattr(trial, 'response_phase1'):
+                stages = {trial.response_phase1: (0, self.session.response_slider1),
+                          trial.response_phase2: (1, self.session.response_slider2)}
+            else:
+                stages = {trial.response_phase: (0, self.session.response_slider)}
+
+            if trial.phase in stages:
+                stage, slider = stages[trial.phase]
+                value, rt = self.trial_plan[stage]
+
+                if rt is not None:
+                    # Moves the marker from where it starts (works for absolute and relative input)
+                    delta = (slider.markerToMousePosition(value) -
+                             slider.markerToMousePosition(slider.marker_position)) * self.mouse_multiplier
+                    self.movement = (now, .7 * rt, self.mouse_pos.copy(), np.array([delta, 0.0]))
+                    self.click_time = now + rt
+
+    def _press(self, t, key):
+        self.keys.append((t, key))
+        self.keys.sort(key=lambda k: k[0])
+
+    def get_keys(self, keyList=None, timeStamped=False):
+        self._poll()
+        now = self._now()
+
+        due = [(t, key) for t, key in self.keys if t <= now]
+        self.keys = [(t, key) for t, key in self.keys if t > now]
+
+        if keyList is not None:
+            due = [(t, key) for t, key in due if key in keyList]
+
+        if timeStamped is False:
+            return [key for t, key in due]
+        elif timeStamped is True:
+            return [[key, t] for t, key in due]
+        else:
+            return [[key, timeStamped.getTime() - (now - t)] for t, key in due]
+
+    def clear_keys(self):
+        self.keys = [(t, key) for t, key in self.keys if t > self._now()]
+
+    def get_pos(self):
+        self._poll()
+
+        if self.movement is not None:
+            onset, duration, start, delta = self.movement
+            s = np.clip((self._now() - onset) / duration, 0, 1)
+            self.mouse_pos = start + delta * (10 * s**3 - 15 * s**4 + 6 * s**5)
+
+        return self.mouse_pos.copy()
+
+    def set_pos(self, pos):
+        pos = np.array(pos, dtype=float)
+
+        if self.movement is not None:
+            # Warping the cursor shifts the rest of the movement
+            onset, duration, start, delta = self.movement
+            self.movement = (onset, duration, start + pos - self.get_pos(), delta)
+
+        self.mouse_pos = pos
+
+    def get_pressed(self):
+        self._poll()
+        pressed = (self.click_time is not None) and (self._now() >= self.click_time)
+        return [int(pressed), 0, 0]
+
+
+class SimulatedMouse(object):
+    """ Stands in for `psychopy.event.Mouse`. """
+
+    def __init__(self, simulated_input=None, *args, **kwargs):
+        self.simulated_input = simulated_input
+        self.visible = kwargs.get('visible', False)
+        self._pos = np.zeros(2)
+        # As in PsychoPy, getRel() is relative to the position of the last getPos(), setPos() or getRel()
+        self._last_pos = np.zeros(2)
+
+    def _get_pos(self):
+        if self.simulated_input is None:
+            return self._pos.copy()
+        return self.simulated_input.get_pos()
+
+    def getPos(self):
+        self._last_pos = self._get_pos()
+        return self._last_pos.copy()
+
+    def setPos(self, newPos=(0, 0)):
+        if self.simulated_input is None:
+            self._pos = np.array(newPos, dtype=float)
+        else:
+            self.simulated_input.set_pos(newPos)
+        self._last_pos = np.array(newPos, dtype=float)
+
+    def getRel(self):
+        pos = self._get_pos()
+        rel = pos - self._last_pos
+        self._last_pos = pos
+        return rel
+
+    def getPressed(self, getTime=False):
+        if self.simulated_input is None:
+            return [0, 0, 0]
+        return self.simulated_input.get_pressed()
+
+    def setVisible(self, visible):
+        self.visible = visible
+
+    def clickReset(self, *args, **kwargs):
+        pass
+
+
+_active_input = None
+
+
+def _get_keys(keyList=None, timeStamped=False, *args, **kwargs):
+    if _active_input is None:
+        return []
+    return _active_input.get_keys(keyList=keyList, timeStamped=timeStamped)
+
+
+def _clear_events(*args, **kwargs):
+    if _active_input is not None:
+        _active_input.clear_keys()
+
+
+def _patch_psychopy():
+    """ Replaces PsychoPy's stimuli, mouse and keyboard by their null/simulated counterparts. """
+    for module in ['stimuli', 'task', 'session', 'utils', 'instruction', 'exptools2.core']:
+        if module in sys.modules:
+            raise RuntimeError(f'headless has to be imported before {module}')
+
+    for name in ['Circle', 'Rect', 'Line', 'TextStim', 'TextBox2', 'Pie', 'BufferImageStim', 'ShapeStim',
+                 'ElementArrayStim', 'RadialStim', 'ImageStim', 'GratingStim', 'Slider']:
+        setattr(visual, name, NullStim)
+
+    event.Mouse = SimulatedMouse
+    event.getKeys = _get_keys
+    event.clearEvents = _clear_events
+
+
+_patch_psychopy()
+
+from session import WTPSession  # noqa: E402 (needs the patched PsychoPy)
+from mouse_sampler import MouseSampler  # noqa: E402
+from scanner import SimulatedTriggerSource, TriggerListener  # noqa: E402
+from gaze import GazeSampler, SimulatedGazeSource  # noqa: E402
+from utils import get_output_dir_str, get_settings  # noqa: E402
+
+
+class SimulatedTimeSampling(object):
+    """ Makes a sampler take its samples in simulated (instead of wall-clock) time, while the NullWindow flips. """
+
+    def _init_simulated_time(self, win):
+        self.win = win
+        self.started = False
+        self.next_sample = None
+
+    @property
+    def running(self):
+        return self.started
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self.next_sample = self.win.simulated_time.now
+            self.win.samplers.append(self)
+
+    def stop(self):
+        if self.started:
+            self.started = False
+            self.win.samplers.remove(self)
+
+    def advance(self, t):
+        """ Takes all samples up to simulated time `t`. """
+        while self.next_sample <= t:
+            self.win.simulated_time.now = self.next_sample
+            self._sample()
+            self.next_sample += self.period
+
+
+class SimulatedMouseSampler(SimulatedTimeSampling, MouseSampler):
+    """ Stands in for the window's mouse events: samples the simulated mouse at a fixed rate, in simulated time. """
+
+    def __init__(self, mouse, clock, win, rate=500., **kwargs):
+        super().__init__(mouse, clock, win, **kwargs)
+        self.period = 1. / rate
+        self._init_simulated_time(win)
+
+    def _sample(self):
+        self.left_pressed = bool(self.mouse.getPressed()[0])
+        super()._sample()
+
+
+class SimulatedGazeSampler(SimulatedTimeSampling, GazeSampler):
+
+    def __init__(self, source, clock, win, rate=500., **kwargs):
+        super().__init__(source, clock, rate=rate, **kwargs)
+        self._init_simulated_time(win)
+
+
+class SimulatedTriggerListener(TriggerListener):
+    """ Polls the (simulated) scanner while the NullWindow flips, instead of in a background thread. """
+
+    def __init__(self, source, tr, win, **kwargs):
+        super().__init__(source, tr, **kwargs)
+        self.win = win
+        self.started = False
+
+    @property
+    def running(self):
+        return self.started
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self.win.samplers.append(self)
+
+    def stop(self):
+        if self.started:
+            self.started = False
+            self.win.samplers.remove(self)
+
+    def advance(self, t):
+        self.win.simulated_time.now = t
+        self.poll()
+
+
+class HeadlessWTPSession(WTPSession):
+    """ WTPSession on a NullWindow, in simulated time, with a simulated participant and scanner. """
+
+    def __init__(self, output_str, participant=None, frame_rate=60., scripted_keys=None, tr_drift=0.0,
+                 tr_jitter=0.0, scanner_seed=None, gaze_seed=None, **kwargs):
+        global _active_input
+
+        self.simulated_time = SimulatedTime()
+        self.frame_rate = frame_rate
+        self.gaze_seed = gaze_seed
+
+        super().__init__(output_str, **kwargs)
+
+        self.clock = SimulatedClock(self.simulated_time)
+        self.timer = SimulatedClock(self.simulated_time)
+
+        # Started when the session waits for the scanner (see SimulatedInput)
+        self.trigger_source = SimulatedTriggerSource(self.clock, self.settings['mri']['TR'], drift=tr_drift,
+                                                     jitter=tr_jitter, seed=scanner_seed)
+
+        if participant is None:
+            participant = SimulatedParticipant()
+
+        self.simulated_input = SimulatedInput(self, participant, scripted_keys=scripted_keys)
+        self.mouse = SimulatedMouse(self.simulated_input)
+        _active_input = self.simulated_input
+
+    def _create_mouse_sampler(self):
+        return SimulatedMouseSampler(self.mouse, self.clock, self.win)
+
+    def _create_gaze_sampler(self):
+        fixation_check = self.settings.get('fixation_check', {})
+
+        if fixation_check.get('gaze_source') in ['off', False, None]:
+            return None
+
+        # Also stands in for the eye tracker
+        return SimulatedGazeSampler(SimulatedGazeSource(self.clock, seed=self.gaze_seed), self.clock, self.win,
+                                    radius=fixation_check.get('radius', 1.5),
+                                    max_age=fixation_check.get('max_sample_age', .1))
+
+    def _create_trigger_listener(self):
+        if self.settings['mri'].get('trigger_source', 'keyboard') in ['off', False, None]:
+            return None
+        return SimulatedTriggerListener(self.trigger_source, self.settings['mri']['TR'], self.win)
+
+    def _create_window(self):
+        self.actual_framerate = self.frame_rate
+        return NullWindow(self.simulated_time, monitor=self.settings['monitor'].copy(), frame_rate=self.frame_rate,
+                          size=self.settings['window'].get('size', (1200, 1200)),
+                          units=self.settings['window'].get('units', 'deg'),
+                          colorSpace=self.settings['window'].get('colorSpace', 'rgb'))
+
+
+def main(subject, session, run, slider_type='natural', settings='default', n_sessions=1, frame_rate=60.,
+         replay=None, seed=None, p_miss=0.0, tr_drift=0.0, tr_jitter=0.0):
+
+    settings_fn, _ = get_settings(settings)
+    rng = np.random.RandomState(seed)
+
+    for ix in range(n_sessions):
+        subject_label = subject if n_sessions == 1 else f'{subject}{ix + 1:03d}'
+        output_dir, output_str = get_output_dir_str(subject_label, session, 'estimation_task', run)
+
+        # The session's SeedSequence makes the generators of all trials
+        session_seed = rng.randint(2**31 - 1)
+
+        if replay is None:
+            participant = SimulatedParticipant(p_miss=p_miss, seed=rng.randint(2**31 - 1))
+        else:
+            participant = ScriptedParticipant.from_events(replay)
+
+        scanner_seed, gaze_seed = rng.randint(2**31 - 1, size=2)
+
+        start = time.perf_counter()
+        sim_session = HeadlessWTPSession(output_str=output_str, subject=subject_label, output_dir=output_dir,
+                                         settings_file=settings_fn, run=run, eyetracker_on=False,
+                                         slider_type=slider_type, participant=participant, frame_rate=frame_rate,
+                                         tr_drift=tr_drift, tr_jitter=tr_jitter, scanner_seed=scanner_seed,
+                                         gaze_seed=gaze_seed, seed=session_seed)
+        sim_session.create_trials()
+        sim_session.run()
+
+        duration = time.perf_counter() - start
+        print(f"Simulated {sim_session.simulated_time.now:.1f} s of sub-{subject_label} in {duration:.2f} s "
+              f"({sim_session.simulated_time.now / duration:.0f}x real time)")
+
+        plt.close('all')
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('subject', type=str, help='Subject nr (label prefix when simulating several sessions)')
+    argparser.add_argument('session', type=str, help='Session')
+    argparser.add_argument('run', type=int, help='Run')
+    argparser.add_argument('--settings', type=str, help='Settings label', default='default')
+    argparser.add_argument('--slider_type', type=str, default='natural', help='Response bar type',
+                           choices=['natural', 'log', 'two-stage', 'two-sliders'])
+    argparser.add_argument('--n_sessions', type=int, default=1, help='Number of sessions to simulate')
+    argparser.add_argument('--frame_rate', type=float, default=60., help='Simulated refresh rate (Hz)')
+    argparser.add_argument('--replay', type=str, default=None,
+                           help='Give the responses of this _events.tsv file instead of simulated ones')
+    argparser.add_argument('--p_miss', type=float, default=0.0, help='Probability that a simulated trial is missed')
+    argparser.add_argument('--seed', type=int, default=None, help='Seed for the simulated sessions')
+    argparser.add_argument('--tr_drift', type=float, default=0.0,
+                           help='Relative deviation of the simulated scanner\'s TR from the TR in the settings')
+    argparser.add_argument('--tr_jitter', type=float, default=0.0, help='SD of the simulated pulse times (s)')
+
+    args = argparser.parse_args()
+
+    main(args.subject, args.session, args.run, slider_type=args.slider_type, settings=args.settings,
+         n_sessions=args.n_sessions, frame_rate=args.frame_rate, replay=args.replay, seed=args.seed,
+         p_miss=args.p_miss, tr_drift=args.tr_drift, tr_jitter=args.tr_jitter)
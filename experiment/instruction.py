@@ -1,11 +1,10 @@
-from psychopy.visual import TextStim
-from exptools2.core import Trial
+from logged_trial import LoggedTrial
 import numpy as np
 
-class InstructionTrial(Trial):
+class InstructionTrial(LoggedTrial):
 
     def __init__(self, session, trial_nr, txt, bottom_txt=None, keys=None, phase_durations=None, 
-                 phase_names=None, **kwargs):
+                 phase_names=None, txt_pos=(0.0, 0.0), **kwargs):
 
         self.keys = keys
 
@@ -21,19 +20,24 @@ class InstructionTrial(Trial):
         txt_width = self.session.settings['various'].get('text_width')
         txt_color = self.session.settings['various'].get('text_color')
 
-        self.text = TextStim(session.win, txt,
-                             pos=(0.0, 0.0), height=txt_height, wrapWidth=txt_width, color=txt_color)
+        # Shared between trials with the same text, so these should not be modified
+        self.text = session.stimulus_registry.get_text(txt, txt_height, wrapWidth=txt_width, color=txt_color,
+                                                       pos=txt_pos)
 
         if bottom_txt is None:
             bottom_txt = "Press any button to continue"
 
-        self.text2 = TextStim(session.win, bottom_txt, pos=(
-            0.0, -6.0), height=txt_height, wrapWidth=txt_width,
-            color=txt_color)
+        self.text2 = session.stimulus_registry.get_text(bottom_txt, txt_height, wrapWidth=txt_width, color=txt_color,
+                                                        pos=(0.0, -6.0))
+
+    def log_phase_info(self, phase=None):
+        super().log_phase_info(phase=phase)
+        self.session.frame_timing.phase_started(self, self.phase if phase is None else phase,
+                                                self.session.clock.getTime())
 
     def get_events(self):
 
-        events = Trial.get_events(self)
+        events = LoggedTrial.get_events(self)
 
         if self.keys is None:
             if events:
@@ -54,4 +58,72 @@ class InstructionTrial(Trial):
 
         self.session.fixation_lines.draw(draw_fixation_cross=False)
         self.text.draw()
-        self.text2.draw()
\ No newline at end of file
+        self.text2.draw()
+
+
+class DummyWaiterTrial(InstructionTrial):
+    """ Simple trial with text (trial x) and fixation. """
+
+    def __init__(self, session, trial_nr, phase_durations=None, n_triggers=1,
+                 txt="Waiting for scanner triggers.", **kwargs):
+
+        phase_durations = [np.inf] * n_triggers
+        phase_names = [f'trigger_{n+1}' for n in range(n_triggers)]
+
+        super().__init__(session, trial_nr, txt=txt, phase_durations=phase_durations,
+                         bottom_txt='', 
+                         phase_names=phase_names,
+                         **kwargs)
+
+        self.last_trigger = 0.0
+
+    def run(self):
+        if self.session.trigger_listener is not None:
+            # Only pulses from now on count
+            self.session.trigger_listener.arm()
+
+        super().run()
+
+    def get_events(self):
+        if hasattr(self.session.trials, 'prefetch'):
+            self.session.trials.prefetch()
+
+        events = LoggedTrial.get_events(self)
+
+        if self.session.trigger_listener is not None:
+            # One phase per pulse, even if several came in since the last frame
+            if self.session.trigger_listener.get_pulse() is not None:
+                self.stop_phase()
+        elif events:
+            for key, t in events:
+                if key == self.session.mri_trigger:
+                    if t - self.last_trigger > .5:
+                        self.stop_phase()
+                        self.last_trigger = t
+
+class OutroTrial(InstructionTrial): 
+    """ Simple trial with only fixation cross.  """
+
+    def __init__(self, session, trial_nr=0, phase_durations=None, **kwargs):
+
+        txt = '''Please lie still for a few moments.'''
+
+        if phase_durations is None:
+            phase_durations = [5*60]
+
+        super().__init__(session=session, trial_nr=trial_nr, phase_durations=phase_durations, txt=txt,
+                         bottom_txt='', 
+                         phase_names=['outro'],
+                         **kwargs)
+
+    def draw(self):
+        self.session.fixation_lines.draw()
+        super().draw()
+
+    def get_events(self):
+        events = LoggedTrial.get_events(self)
+
+        if events:
+            for key, t in events:
+                if key == 'space':
+                    self.stop_phase()
@@ -0,0 +1,49 @@
+from psychopy import event
+from exptools2.core import Trial
+
+
+class LoggedTrial(Trial):
+    """ Trial that logs its phases and key events to the session's `EventLedger` instead of `global_log`. """
+
+    def log_phase_info(self, phase=None):
+        onset = self.session.clock.getTime()
+
+        if phase is None:
+            phase = self.phase
+
+        if phase == 0:
+            self.start_trial = onset
+
+        if self.session.eyetracker_on:
+            self.session.tracker.sendMessage(f'start_type-stim_trial-{self.trial_nr}_phase-{phase}')
+
+        self.session.event_ledger.log_phase(self.trial_nr, onset, self.phase_names[phase], phase,
+                                            self.session.nr_frames, parameters=self.parameters)
+        self.session.nr_frames = 0
+
+    def get_events(self):
+        events = event.getKeys(timeStamped=self.session.clock)
+
+        if events:
+            if 'q' in [ev[0] for ev in events]:
+                self.session.close()
+                self.session.quit()
+
+            for key, t in events:
+                if key == self.session.mri_trigger:
+                    event_type = 'pulse'
+                else:
+                    event_type = 'response'
+
+                self.session.event_ledger.log_key(self.trial_nr, t, event_type, self.phase, key,
+                                                  parameters=self.parameters)
+
+                if self.session.eyetracker_on:
+                    self.session.tracker.sendMessage(f'start_type-{event_type}_trial-{self.trial_nr}_'
+                                                     f'phase-{self.phase}_key-{key}_time-{t}')
+
+                if key != self.session.mri_trigger:
+                    self.last_resp = key
+                    self.last_resp_onset = t
+
+        return events
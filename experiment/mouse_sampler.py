@@ -0,0 +1,126 @@
+import logging
+import os
+import os.path as op
+import numpy as np
+
+
+class MouseSampler(object):
+    """ Records every mouse movement and button press of the window, with its session time.
+
+    The samples (session time, position and left button) come from pyglet's
+    mouse events, which the window dispatches on the main thread (on every
+    flip, and whenever the keyboard or the mouse buttons are polled). They
+    are written into preallocated ring buffers. The samples of every trial
+    are kept (see `record_trial()`) and saved as one binary file when the
+    session ends.
+
+    The mouse is never polled from another thread: PsychoPy's
+    `Mouse.getPressed()` dispatches the window's events, which may only
+    happen on the main thread (and the position only changes when they are
+    dispatched anyway). Only pyglet windows are supported.
+    """
+
+    dtype = np.dtype([('trial_nr', np.int32), ('time', np.float64), ('x', np.float32), ('y', np.float32),
+                      ('pressed', np.uint8)])
+
+    def __init__(self, mouse, clock, win, buffer_size=2**16):
+        self.mouse = mouse
+        self.clock = clock
+        self.win = win
+        self.buffer_size = buffer_size
+
+        self.times = np.zeros(buffer_size)
+        self.positions = np.zeros((buffer_size, 2))
+        self.pressed = np.zeros(buffer_size, dtype=np.uint8)
+        # Total number of samples taken (the next one goes to n_samples % buffer_size)
+        self.n_samples = 0
+
+        self.left_pressed = False
+        self.trajectories = []
+        self._handlers = None
+
+    @property
+    def running(self):
+        return self._handlers is not None
+
+    def start(self):
+        if self.running:
+            return
+
+        win_handle = getattr(self.win, 'winHandle', None)
+
+        if not hasattr(win_handle, 'push_handlers'):
+            logging.warning(f'Mouse trajectories can only be recorded in pyglet windows '
+                            f'(got {getattr(self.win, "winType", None)!r})')
+            return
+
+        self._handlers = {'on_mouse_motion': self._on_motion, 'on_mouse_drag': self._on_drag,
+                          'on_mouse_press': self._on_press, 'on_mouse_release': self._on_release}
+        # The handlers return None, so the window's own handlers still get the events
+        win_handle.push_handlers(**self._handlers)
+
+    def stop(self):
+        if self.running:
+            self.win.winHandle.remove_handlers(**self._handlers)
+            self._handlers = None
+
+    def _on_motion(self, x, y, dx, dy):
+        self._sample()
+
+    def _on_drag(self, x, y, dx, dy, buttons, modifiers):
+        self._sample()
+
+    def _on_press(self, x, y, button, modifiers):
+        if button == 1:  # pyglet.window.mouse.LEFT
+            self.left_pressed = True
+        self._sample()
+
+    def _on_release(self, x, y, button, modifiers):
+        if button == 1:
+            self.left_pressed = False
+        self._sample()
+
+    def _sample(self):
+        ix = self.n_samples % self.buffer_size
+        # The window has already stored the position of the event, getPos() only converts it
+        self.positions[ix] = self.mouse.getPos()
+        self.pressed[ix] = self.left_pressed
+        self.times[ix] = self.clock.getTime()
+        self.n_samples += 1
+
+    def get_samples(self, start, end=None):
+        """ Samples `start` up to `end` (sample counts, as returned by `n_samples`) that are still in the buffer. """
+        if end is None:
+            end = self.n_samples
+
+        if end - start > self.buffer_size:
+            logging.warning(f'Mouse sample buffer overflow: only the last {self.buffer_size} '
+                            f'of {end - start} samples are kept')
+            start = end - self.buffer_size
+
+        ixs = np.arange(start, end) % self.buffer_size
+        samples = np.zeros(len(ixs), dtype=self.dtype)
+        samples['time'] = self.times[ixs]
+        samples['x'], samples['y'] = self.positions[ixs].T
+        samples['pressed'] = self.pressed[ixs]
+
+        return samples
+
+    def record_trial(self, trial_nr, start):
+        """ Keeps the samples from `start` on as the trajectory of trial `trial_nr`. """
+        samples = self.get_samples(start)
+        samples['trial_nr'] = trial_nr
+        self.trajectories.append(samples)
+
+    def save(self, output_dir, output_str):
+        if not op.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        fn = op.join(output_dir, f'{output_str}_mouse.npy')
+
+        if self.trajectories:
+            np.save(fn, np.concatenate(self.trajectories))
+        else:
+            np.save(fn, np.zeros(0, dtype=self.dtype))
+
+        return fn
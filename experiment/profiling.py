@@ -0,0 +1,100 @@
+import functools
+import os
+import os.path as op
+import time
+import numpy as np
+import pandas as pd
+
+
+class FrameProfiler(object):
+    """ Collects the durations of instrumented calls, per method and per trial phase.
+
+    Durations are written into preallocated arrays (`max_samples` per method and
+    phase; later calls are counted but not stored). Methods are only wrapped by
+    `instrument()`, so there is no overhead at all when profiling is off, and
+    `restore()` puts the original methods back (at the end of the session).
+    """
+
+    def __init__(self, max_samples=50000):
+        self.max_samples = max_samples
+        self.phase_name = None
+        self.durations = {}
+        self.n_calls = {}
+        self.originals = []
+
+    def record(self, section, duration):
+        key = (section, self.phase_name)
+
+        if key not in self.durations:
+            self.durations[key] = np.empty(self.max_samples)
+            self.n_calls[key] = 0
+
+        n = self.n_calls[key]
+        if n < self.max_samples:
+            self.durations[key][n] = duration
+        self.n_calls[key] = n + 1
+
+    def instrument(self, cls, method, sets_phase=False):
+        """ Wraps `cls.method` (if `cls` defines it itself) so that its duration is recorded.
+
+        With `sets_phase`, the method belongs to a trial, and the name of the
+        current phase is used for all calls (including stimulus draws) it makes.
+        """
+        if method not in cls.__dict__:
+            return
+
+        # A method that is still wrapped (by a profiler that was not restored) is wrapped anew
+        func = getattr(cls.__dict__[method], '_unprofiled', cls.__dict__[method])
+        section = f'{cls.__name__}.{method}'
+        profiler = self
+
+        if sets_phase:
+            @functools.wraps(func)
+            def wrapper(obj, *args, **kwargs):
+                previous_phase_name = profiler.phase_name
+                profiler.phase_name = obj.phase_names[obj.phase]
+                start = time.perf_counter()
+                result = func(obj, *args, **kwargs)
+                profiler.record(section, time.perf_counter() - start)
+                profiler.phase_name = previous_phase_name
+                return result
+        else:
+            @functools.wraps(func)
+            def wrapper(obj, *args, **kwargs):
+                start = time.perf_counter()
+                result = func(obj, *args, **kwargs)
+                profiler.record(section, time.perf_counter() - start)
+                return result
+
+        wrapper._unprofiled = func
+        self.originals.append((cls, method, func))
+        setattr(cls, method, wrapper)
+
+    def restore(self):
+        """ Puts back the methods that `instrument()` wrapped. """
+        for cls, method, func in reversed(self.originals):
+            setattr(cls, method, func)
+
+        self.originals = []
+
+    def summary(self):
+        """ Number of calls and duration percentiles (in ms) per method and phase. """
+        rows = []
+        for (section, phase_name), durations in self.durations.items():
+            n_calls = self.n_calls[(section, phase_name)]
+            durations = durations[:min(n_calls, self.max_samples)] * 1000.
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            rows.append({'section': section, 'phase': phase_name, 'n_calls': n_calls,
+                         'mean': durations.mean(), 'p50': p50, 'p95': p95, 'p99': p99, 'max': durations.max()})
+
+        summary = pd.DataFrame(rows, columns=['section', 'phase', 'n_calls', 'mean', 'p50', 'p95', 'p99', 'max'])
+        return summary.sort_values(['section', 'phase'], na_position='first').round(4)
+
+    def save(self, output_dir, output_str):
+        if not op.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        fn = op.join(output_dir, f'{output_str}_profile.tsv')
+        self.summary().to_csv(fn, sep='\t', index=False)
+
+        return fn
@@ -0,0 +1,62 @@
+""" Rebuilds the events file of a session from its event stream.
+
+When a session does not end normally (e.g., the stimulus PC crashes), the
+`_events.tsv` file is never written. Everything up to the last completed
+trial is still in `<output>_events.jsonl` (see `event_stream.py`), and this
+script turns it into the usual events file:
+
+    python recover_log.py logs/sub-1/ses-1/sub-1_ses-1_task-estimation_task_run-1_events.jsonl
+"""
+import argparse
+import logging
+import os.path as op
+import numpy as np
+from event_ledger import EventLedger
+from event_stream import read_stream
+
+
+def recover_log(events, exp_start=0.0):
+    """ The events log as exptools2 writes it when the session closes. """
+    log = EventLedger.from_events(events).to_dataframe()
+
+    log['onset_abs'] = log['onset'] + exp_start
+
+    # Only phases have a duration (and the end of the last one is unknown)
+    phase_ix = ~log.event_type.isin(['response', 'trigger', 'pulse'])
+    log.loc[phase_ix, 'duration'] = np.append(log.loc[phase_ix, 'onset'].diff().values[1:], np.nan)
+
+    # Phases are logged with the number of frames of the phase before them
+    log.loc[phase_ix, 'nr_frames'] = np.append(log.loc[phase_ix, 'nr_frames'].values[1:], np.nan)
+
+    return log.round({'onset': 5, 'onset_abs': 5, 'duration': 5})
+
+
+def main(stream_fn, output=None, overwrite=False):
+    header, events = read_stream(stream_fn)
+
+    if output is None:
+        output = stream_fn[:-len('.jsonl')] + '.tsv' if stream_fn.endswith('.jsonl') else stream_fn + '.tsv'
+
+    if op.exists(output) and not overwrite:
+        raise FileExistsError(f'{output} already exists (use --overwrite to replace it)')
+
+    if len(events) == 0:
+        logging.warning(f'No events in {stream_fn}')
+
+    log = recover_log(events, exp_start=header.get('exp_start', 0.0))
+    log.to_csv(output, sep='\t', index=True)
+
+    n_trials = log.loc[log.trial_nr > 0, 'trial_nr'].nunique()
+    print(f"Recovered {len(log)} events ({n_trials} task trials) of {header.get('output_str', stream_fn)} "
+          f"to {output}")
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('stream', type=str, help='Event stream (<output>_events.jsonl)')
+    argparser.add_argument('--output', type=str, default=None, help='Events file (default: <output>_events.tsv)')
+    argparser.add_argument('--overwrite', action='store_true', help='Replace an existing events file')
+
+    args = argparser.parse_args()
+
+    main(args.stream, output=args.output, overwrite=args.overwrite)
@@ -0,0 +1,104 @@
+import numpy as np
+
+
+class ResponseController(object):
+    """ Turns mouse input into a response on a slider.
+
+    Goes through the states 'idle', 'armed' (marker at its start position,
+    hidden), 'tracking' (marker follows the mouse), 'committed' (after a
+    click) and 'feedback'. The mouse is only touched when tracking starts:
+    in 'absolute' mode, the cursor is warped to the marker once, in
+    'relative' mode, the marker moves by the movement of the cursor from then
+    on (so the cursor does not have to be on the marker, but its movement
+    still stops at the window edges).
+    """
+
+    def __init__(self, session, slider, mode='absolute', min_rt=0.0):
+        assert mode in ['absolute', 'relative']
+
+        self.session = session
+        self.slider = slider
+        self.mode = mode
+        self.min_rt = min_rt
+
+        self.mouse_multiplier = session.settings['interface']['mouse_multiplier']
+        self.color = session.settings['slider'].get('color')
+        self.feedback_color = session.settings['slider'].get('feedbackColor')
+
+        self.state = 'idle'
+        self.position = None
+        self.mouse_pos = None
+        self.onset = None
+        self.response = None
+        self.response_onset = None
+        self.response_time = None
+
+    @property
+    def committed(self):
+        return self.state in ['committed', 'feedback']
+
+    def _set_marker_color(self, color):
+        # Only the marker of ResponseSliders has a separate inner color
+        if hasattr(self.slider.marker, 'inner_color'):
+            self.slider.marker.inner_color = color
+
+    def arm(self, start_value):
+        if self.state != 'idle':
+            return
+
+        self.slider.setMarkerPosition(start_value)
+        self.slider.show_marker = False
+        self._set_marker_color(self.color)
+        self.state = 'armed'
+
+    def _start_tracking(self):
+        mouse = self.session.mouse
+        self.position = self.slider.markerToMousePosition(self.slider.marker_position)
+
+        if self.mode == 'absolute':
+            mouse.setPos((self.position * self.mouse_multiplier, 0))
+        else:
+            # The movement is measured from here
+            self.mouse_pos = self.session.get_mouse_pos()
+
+        self.slider.show_marker = True
+        self.onset = self.session.event_ledger.phase_onset
+        self.state = 'tracking'
+
+    def track(self):
+        """ Moves the marker with the mouse. Returns True on the frame the response is committed. """
+        if self.state in ['committed', 'feedback']:
+            return False
+
+        if self.state != 'tracking':
+            # The cursor only gets to the marker on the next frame
+            self._start_tracking()
+        elif self.mode == 'absolute':
+            self.position = self.session.get_mouse_pos()[0] / self.mouse_multiplier
+        else:
+            # The difference of the sampled positions: mouse.getRel() is relative to the last
+            # getPos() of anyone, and the mouse sampler calls that hundreds of times per second
+            mouse_pos = self.session.get_mouse_pos()
+            self.position += (mouse_pos[0] - self.mouse_pos[0]) / self.mouse_multiplier
+            self.mouse_pos = mouse_pos
+            # Moving beyond the ends of the slider does not build up
+            self.position = np.clip(self.position, self.slider.bar.pos[0] - self.slider.bar.width / 2.,
+                                    self.slider.bar.pos[0] + self.slider.bar.width / 2.)
+
+        self.slider.setMarkerPosition(self.slider.mouseToMarkerPosition(self.position))
+
+        now = self.session.clock.getTime()
+
+        if (now - self.onset >= self.min_rt) and self.session.mouse.getPressed()[0]:
+            self.response = self.slider.marker_position
+            self.response_onset = now
+            self.response_time = now - self.onset
+            self.state = 'committed'
+            return True
+
+        return False
+
+    def feedback(self):
+        if self.state == 'committed':
+            self._set_marker_color(self.feedback_color)
+            self.state = 'feedback'
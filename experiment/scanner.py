@@ -0,0 +1,303 @@
+import logging
+import os
+import os.path as op
+import queue
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+
+class TRModel(object):
+    """ Online model of volume onsets (onset = t0 + tr * volume).
+
+    The onsets are regressed on the volume numbers with running sums, so
+    every update takes constant time. Pulses that are missed (more than
+    1.5 TR between two pulses) still count as volumes. The jitter is the
+    standard deviation of the prediction errors (the pulse onset minus
+    the onset that was predicted before the pulse came in).
+
+    The estimates are published together as one tuple (`estimate`, t0 and
+    TR), so that other threads never combine a new t0 with an old TR.
+    """
+
+    def __init__(self, tr):
+        self.nominal_tr = tr
+        self.estimate = (None, tr)
+
+        self.n_volumes = 0
+        self.last_volume = None
+        self.last_onset = None
+
+        self._sums = np.zeros(5)  # n, x, y, xx, xy
+        self._n_errors = 0
+        self._mean_error = 0.0
+        self._m2_error = 0.0
+
+    @property
+    def t0(self):
+        return self.estimate[0]
+
+    @property
+    def tr(self):
+        return self.estimate[1]
+
+    @property
+    def drift(self):
+        """ Relative deviation of the estimated from the nominal TR. """
+        return self.tr / self.nominal_tr - 1.
+
+    @property
+    def jitter(self):
+        if self._n_errors < 2:
+            return np.nan
+        return np.sqrt(self._m2_error / (self._n_errors - 1))
+
+    def predict(self, volume):
+        t0, tr = self.estimate
+
+        if t0 is None:
+            return np.nan
+        return t0 + tr * volume
+
+    def update(self, onset):
+        """ Adds a pulse and returns its volume number and prediction error. """
+        if self.last_volume is None:
+            volume = 0
+            error = np.nan
+        else:
+            volume = self.last_volume + max(1, int(np.round((onset - self.last_onset) / self.tr)))
+            error = onset - self.predict(volume)
+
+            # Welford's running variance
+            self._n_errors += 1
+            delta = error - self._mean_error
+            self._mean_error += delta / self._n_errors
+            self._m2_error += delta * (error - self._mean_error)
+
+        self._sums += [1, volume, onset, volume**2, volume * onset]
+        n, x, y, xx, xy = self._sums
+
+        tr = (n * xy - x * y) / (n * xx - x**2) if n >= 2 else self.tr
+        self.estimate = ((y - tr * x) / n, tr)
+
+        self.n_volumes += 1
+        self.last_volume = volume
+        self.last_onset = onset
+
+        return volume, error
+
+    def next_volume(self, t):
+        """ Number and predicted onset of the first volume that starts at or after `t`. """
+        t0, tr = self.estimate
+        volume = max(int(np.ceil((t - t0) / tr - 1e-6)), 0)
+        return volume, t0 + tr * volume
+
+
+class KeyboardTriggerSource(object):
+    """ Scanner triggers that arrive as the sync key, timestamped by Psychtoolbox's keyboard queue.
+
+    Only works with the 'ptb' keyboard backend: the other backends get their
+    key presses from the window's event loop (and would take them away from
+    the trials).
+    """
+
+    def __init__(self, keyboard, sync_key, clock):
+        self.keyboard = keyboard
+        self.sync_key = sync_key
+        self.clock = clock
+
+    @classmethod
+    def create(cls, sync_key, clock):
+        from psychopy.hardware import keyboard
+
+        kb = keyboard.Keyboard(clock=clock)
+        # The keyboard device may have been made before (with another clock)
+        kb.clock = clock
+
+        if kb.getBackend() != 'ptb':
+            logging.warning(f'Scanner triggers can only be listened for with the ptb keyboard backend '
+                            f'(got {kb.getBackend()!r}), they will be polled by the trials instead')
+            return None
+
+        return cls(kb, sync_key, clock)
+
+    def start(self):
+        pass
+
+    def poll(self):
+        keys = self.keyboard.getKeys(keyList=[self.sync_key], waitRelease=False, clear=True)
+        # rt is relative to the last reset of the keyboard's clock (the session clock); tDown is relative
+        # to PsychoPy's default clock (in recent versions) or absolute (in older ones)
+        return [key.rt for key in keys]
+
+
+class SimulatedTriggerSource(object):
+    """ A scanner that sends a pulse every TR (with optional drift and jitter), from the moment it is started. """
+
+    def __init__(self, clock, tr, drift=0.0, jitter=0.0, seed=None):
+        self.clock = clock
+        self.tr = tr * (1. + drift)
+        self.jitter = jitter
+        self.rng = np.random.default_rng(seed)
+
+        self.start_time = None
+        self._offsets = []
+        self.n_polled = 0
+
+    def start(self, t=None):
+        if self.start_time is None:
+            self.start_time = self.clock.getTime() if t is None else t
+
+    def pulse_time(self, n):
+        while len(self._offsets) <= n:
+            self._offsets.append(self.rng.normal(0.0, self.jitter) if self.jitter > 0 else 0.0)
+
+        return self.start_time + (n + 1) * self.tr + self._offsets[n]
+
+    def pulses_between(self, t0, t1):
+        """ Times of the pulses in (t0, t1]. """
+        if self.start_time is None:
+            return []
+
+        n = max(int((t0 - self.start_time) / self.tr) - 2, 0)
+        pulses = []
+
+        while self.pulse_time(n) <= t1:
+            if self.pulse_time(n) > t0:
+                pulses.append(self.pulse_time(n))
+            n += 1
+
+        return pulses
+
+    def poll(self):
+        if self.start_time is None:
+            return []
+
+        pulses = []
+        now = self.clock.getTime()
+
+        while self.pulse_time(self.n_polled) <= now:
+            pulses.append(self.pulse_time(self.n_polled))
+            self.n_polled += 1
+
+        return pulses
+
+
+class TriggerListener(object):
+    """ Timestamps every scanner trigger of a run in a background thread.
+
+    Pulses are debounced (pulses within half a TR of the previous one are
+    ignored), assigned a volume number and fed to a `TRModel`. Trials take
+    new pulses from a queue (`get_pulse()`) and can align their onsets to
+    predicted volume onsets (`next_volume()`). All volumes are saved, with
+    the TR, drift and jitter estimates at the time, when the session ends.
+    `arm()` starts over: only the pulses after it count.
+    """
+
+    def __init__(self, source, tr, poll_interval=.001, buffer_size=4096):
+        self.source = source
+        self.tr = tr
+        self.poll_interval = poll_interval
+        self.buffer_size = buffer_size
+
+        self.pulses = queue.Queue()
+        # Held while a pulse is added, so that arm() never resets half of it
+        self._lock = threading.Lock()
+        self._reset()
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return (self._thread is not None) and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='TriggerListener', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.poll()
+            time.sleep(self.poll_interval)
+
+    def poll(self):
+        for onset in self.source.poll():
+            self._add(onset)
+
+    def _reset(self):
+        self.model = TRModel(self.tr)
+        self.volumes = np.zeros(self.buffer_size, dtype=[('volume', np.int32), ('onset', np.float64),
+                                                         ('prediction_error', np.float64), ('tr', np.float64),
+                                                         ('drift', np.float64), ('jitter', np.float64)])
+        self.n_pulses = 0
+        self.n_ignored = 0
+
+        while not self.pulses.empty():
+            self.pulses.get_nowait()
+
+    def _add(self, onset):
+        with self._lock:
+            self._add_pulse(onset)
+
+    def _add_pulse(self, onset):
+        model = self.model
+
+        if (model.last_onset is not None) and (onset - model.last_onset < .5 * model.tr):
+            self.n_ignored += 1
+            return
+
+        volume, error = model.update(onset)
+
+        if self.n_pulses == len(self.volumes):
+            self.volumes = np.concatenate((self.volumes, np.zeros_like(self.volumes)))
+
+        self.volumes[self.n_pulses] = (volume, onset, error, model.tr, model.drift, model.jitter)
+        self.n_pulses += 1
+
+        self.pulses.put((volume, onset))
+
+    def arm(self):
+        """ Discards all pulses so far (and the TR model fitted to them) and starts a simulated scanner. """
+        with self._lock:
+            self._reset()
+
+        self.source.start()
+
+    def get_pulse(self):
+        """ The oldest pulse (volume number, onset) that was not taken yet, or None. """
+        try:
+            return self.pulses.get_nowait()
+        except queue.Empty:
+            return None
+
+    def next_volume(self, t):
+        """ Number and predicted onset of the first volume at or after `t` (None before the first pulse). """
+        model = self.model
+
+        if model.t0 is None:
+            return None
+        return model.next_volume(t)
+
+    def summary(self):
+        return (f'{self.n_pulses} volumes ({self.n_ignored} pulses ignored), TR {self.model.tr:.4f} s '
+                f'(drift {self.model.drift * 1e6:+.0f} ppm, jitter {self.model.jitter * 1000:.2f} ms)')
+
+    def save(self, output_dir, output_str):
+        if not op.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        fn = op.join(output_dir, f'{output_str}_volumes.tsv')
+        pd.DataFrame(self.volumes[:self.n_pulses]).to_csv(fn, sep='\t', index=False)
+
+        return fn
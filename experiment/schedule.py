@@ -0,0 +1,195 @@
+""" Precomputes the trials of all runs of a subject.
+
+A schedule fixes everything that is random about a run: the order of the
+probability blocks, the order of the payoffs within every block, the ISI,
+the start position of the response marker, the dot layout (the index into
+the stimulus bank, see `stimulus_bank.py`) and the seed of every trial (its
+own `np.random.Generator` is made from it).
+
+    python schedule.py 1 2 3 --settings scanner --slider_type natural --seed 0
+
+writes `schedules/sub-<subject>_schedule.npz`, with one array per column and
+one row per trial of every run. When `design.py` has written a design for a
+run (`designs/sub-<subject>_run-<run>_design.tsv`), its trial order and ISIs
+are used. `WTPSession.create_trials` loads the rows of its run when the
+subject has a schedule; otherwise, the trials are drawn at the start of the
+run, as before.
+"""
+import argparse
+import os
+import os.path as op
+import numpy as np
+import pandas as pd
+import yaml
+
+# One row per task trial (a probability cue is shown whenever `prob` changes)
+TRIAL_DTYPE = np.dtype([('trial_nr', np.int16), ('prob', np.float64), ('payoff', np.int32),
+                        ('jitter', np.float64), ('start_marker_position', np.float64),
+                        ('layout_ix', np.int32), ('seed', np.int64)])
+
+
+def get_schedule_fn(subject, schedule_dir=None):
+    if schedule_dir is None:
+        schedule_dir = op.join(op.dirname(__file__), 'schedules')
+
+    return op.join(schedule_dir, f'sub-{subject}_schedule.npz')
+
+
+def sample_start_marker_positions(slider_type, slider_range, n, rng):
+    """ Start positions of the response marker, as the trials of `slider_type` draw them. """
+    if slider_type in ['two-stage', 'two-sliders']:
+        return rng.uniform(slider_range[0], slider_range[1], n)
+
+    return rng.integers(slider_range[0], slider_range[1] + 1, n).astype(float)
+
+
+def get_trial_seeds(seed_sequence, n_trials):
+    """ Seeds of the generators of `n_trials` trials, spawned from the run's `SeedSequence`. """
+    return np.array([child.generate_state(1)[0] for child in seed_sequence.spawn(n_trials)], dtype=np.int64)
+
+
+def make_run_table(settings, seed_sequence, slider_type=None, n_layouts=None, design=None):
+    """ The trials of one run, as a structured array (`TRIAL_DTYPE`).
+
+    Without a `slider_type` (or `n_layouts`), the start positions of the
+    marker (or the layouts) are left to the trials (NaN and -1), which draw
+    them from their own generator (seeded with `seed`).
+    """
+    rng = np.random.default_rng(seed_sequence)
+
+    n_trials = settings['task'].get('n_trials')
+    probs = np.array(settings['task'].get('probabilities'))
+    payoffs = np.array(settings['task']['payoffs'])
+
+    # Make sure n_trials is a multiple of 6 and 4 (or throw error)
+    if n_trials % len(probs) != 0:
+        raise ValueError('n_trials should be a multiple of n_probs')
+    if n_trials % len(payoffs) != 0:
+        raise ValueError('n_trials should be a multiple of n_payoffs')
+
+    table = np.zeros(n_trials, dtype=TRIAL_DTYPE)
+    table['trial_nr'] = np.arange(1, n_trials + 1)
+
+    if design is None:
+        n_per_block = n_trials // len(probs)
+        table['prob'] = np.repeat(rng.permutation(probs), n_per_block)
+        table['payoff'] = np.concatenate([rng.permutation(np.resize(payoffs, n_per_block))
+                                          for _ in range(len(probs))])
+
+        possible_isis = settings['durations'].get('isi')
+        isis = possible_isis * int(np.ceil(n_trials / len(possible_isis)))
+        table['jitter'] = isis[:n_trials]
+    else:
+        if len(design) != n_trials:
+            raise ValueError(f'The design has {len(design)} trials, but task.n_trials is {n_trials}')
+
+        for key in ['prob', 'payoff', 'jitter']:
+            table[key] = design[key].values
+
+    if slider_type is None:
+        table['start_marker_position'] = np.nan
+    else:
+        table['start_marker_position'] = sample_start_marker_positions(slider_type, settings['slider']['range'],
+                                                                       n_trials, rng)
+
+    table['layout_ix'] = -1 if n_layouts is None else rng.integers(n_layouts, size=n_trials)
+    table['seed'] = get_trial_seeds(seed_sequence, n_trials)
+
+    return table
+
+
+def save_schedule(fn, tables, **info):
+    """ Stores the trial tables of all runs ({run: table}) column by column. """
+    runs = sorted(tables)
+    columns = {'run': np.concatenate([np.full(len(tables[run]), run, dtype=np.int16) for run in runs])}
+
+    for key in TRIAL_DTYPE.names:
+        columns[key] = np.concatenate([tables[run][key] for run in runs])
+
+    if not op.isdir(op.dirname(fn)):
+        os.makedirs(op.dirname(fn))
+
+    np.savez_compressed(fn, **columns, **{f'info_{key}': value for key, value in info.items()})
+
+
+def load_run_table(fn, run):
+    """ The trial table of one run of a schedule and the information it was made with. """
+    with np.load(fn) as schedule:
+        ix = schedule['run'] == run
+
+        if not ix.any():
+            raise ValueError(f'Schedule {fn} has no trials for run {run}')
+
+        table = np.zeros(ix.sum(), dtype=TRIAL_DTYPE)
+
+        for key in TRIAL_DTYPE.names:
+            table[key] = schedule[key][ix]
+
+        info = {key[len('info_'):]: schedule[key].item() for key in schedule.files if key.startswith('info_')}
+
+    return table, info
+
+
+def main(subjects, n_runs=None, settings='default', slider_type='natural', seed=0, design_dir=None,
+         output_dir=None):
+    from stimulus_bank import StimulusBank
+
+    settings_label = settings
+    settings_fn = op.join(op.dirname(__file__), 'settings', f'{settings}.yml')
+
+    with open(settings_fn, 'r') as f:
+        settings = yaml.safe_load(f)
+
+    if n_runs is None:
+        n_runs = settings.get('main', {}).get('n_runs', 1)
+
+    if design_dir is None:
+        design_dir = op.join(op.dirname(__file__), 'designs')
+
+    stimulus_bank = StimulusBank.from_settings(settings)
+
+    if stimulus_bank is None:
+        print('No stimulus bank found for these cloud settings, dot layouts will be sampled during the runs')
+        n_layouts, bank_id = None, ''
+    else:
+        n_layouts, bank_id = stimulus_bank.n_layouts, stimulus_bank.bank_id
+
+    for subject in subjects:
+        tables = {}
+
+        for run in range(1, n_runs + 1):
+            # The same subject, run and seed always give the same trials
+            seed_sequence = np.random.SeedSequence([seed, run] + list(str(subject).encode()))
+
+            design_fn = op.join(design_dir, f'sub-{subject}_run-{run}_design.tsv')
+            design = pd.read_csv(design_fn, sep='\t') if op.exists(design_fn) else None
+
+            tables[run] = make_run_table(settings, seed_sequence, slider_type=slider_type, n_layouts=n_layouts,
+                                         design=design)
+
+            print(f"sub-{subject} run-{run}: {len(tables[run])} trials"
+                  f"{f' (design {design_fn})' if design is not None else ''}")
+
+        fn = get_schedule_fn(subject, output_dir)
+        save_schedule(fn, tables, subject=str(subject), settings=settings_label, slider_type=slider_type,
+                      seed=seed, stimulus_bank=bank_id)
+
+        print(f'Schedule of sub-{subject} ({n_runs} runs) written to {fn}')
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('subjects', type=str, nargs='+', help='Subject nrs')
+    argparser.add_argument('--n_runs', type=int, default=None, help='Number of runs (default: main.n_runs or 1)')
+    argparser.add_argument('--settings', type=str, help='Settings label', default='default')
+    argparser.add_argument('--slider_type', type=str, default='natural', help='Response bar type',
+                           choices=['natural', 'log', 'two-stage', 'two-sliders'])
+    argparser.add_argument('--seed', type=int, help='Random seed', default=0)
+    argparser.add_argument('--design_dir', type=str, default=None,
+                           help='Designs of design.py to use when they exist (default: designs/)')
+    argparser.add_argument('--output_dir', type=str, default=None, help='Output directory (default: schedules/)')
+
+    args = argparser.parse_args()
+
+    main(args.subjects, n_runs=args.n_runs, settings=args.settings, slider_type=args.slider_type, seed=args.seed,
+         design_dir=args.design_dir, output_dir=args.output_dir)
@@ -1,19 +1,49 @@
-from exptools2.core import PylinkEyetrackerSession, Trial
+from exptools2.core import PylinkEyetrackerSession
 from psychopy import event
-from stimuli import ResponseSlider, FixationLines, TextStim, RangeResponseSlider, DiscreteResponseSlider
+from stimuli import (ResponseSlider, FixationLines, TextStim, RangeResponseSlider, DiscreteResponseSlider, StimulusRegistry,
+                     BufferedStimulus, ProbabilityPieChart, RoundedRectangleWithBorder, GlyphLabel)
 import yaml
 import os.path as op
-from instruction import InstructionTrial
-from task import TaskTrial, OutroTrial, DummyWaiterTrial, ProbCueTrial, TwoStageTasktrial, TwoSliderTasktrial
+from instruction import InstructionTrial, DummyWaiterTrial, OutroTrial
+from task import TaskTrial, ProbCueTrial, TwoStageTasktrial, TwoSliderTasktrial
+from stimulus_bank import StimulusBank
+from schedule import get_schedule_fn, load_run_table, make_run_table
+from utils import StimulusArrayPool, LazyTrialSequence, get_peak_memory, RadialStimArray
+from profiling import FrameProfiler
+from timing import FrameTimingMonitor
+from mouse_sampler import MouseSampler
+from event_ledger import EventLedger
+from event_stream import EventStreamWriter
+from scanner import TriggerListener, KeyboardTriggerSource, SimulatedTriggerSource
+from gaze import GazeSampler, EyeLinkGazeSource, LockedTracker, SimulatedGazeSource
 import numpy as np
+import logging
+import threading
+import time
 
 class WTPSession(PylinkEyetrackerSession):
     def __init__(self, output_str, subject=None, output_dir=None, settings_file=None, run=None, eyetracker_on=False, calibrate_eyetracker=False,
-                 slider_type='natural'):
+                 slider_type='natural', profile=False, seed=None, startup_profiler=None, fixation_check=None):
+
+        self.init_time = time.perf_counter()
+        self.time_to_first_trigger = None
+
+        # The window is created by exptools2's Session
+        self.startup_profiler = startup_profiler
+        if startup_profiler is not None:
+            startup_profiler.mark('session setup')
 
         super().__init__(output_str, output_dir=output_dir, settings_file=settings_file, eyetracker_on=eyetracker_on)
 
+        if startup_profiler is not None:
+            startup_profiler.mark('window created')
+
         self.show_eyetracker_calibration = calibrate_eyetracker
+        # Held for every call to the tracker once the gaze sampler polls it from its thread
+        self.tracker_lock = threading.RLock()
+
+        # Phases and key presses are logged here, global_log is only filled in when the session closes
+        self.event_ledger = EventLedger()
 
         self.mouse = event.Mouse(visible=False)
 
@@ -22,17 +52,69 @@ class WTPSession(PylinkEyetrackerSession):
         self.settings['subject'] = subject
         self.settings['run'] = run
 
+        # The fixation check is off unless the settings or `fixation_check` (the gaze source) turn it on
+        if fixation_check is not None:
+            self.settings.setdefault('fixation_check', {})['gaze_source'] = fixation_check
+
+        # The session and every trial draw from their own generators, spawned from this (logged) seed
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.settings['seed'] = self.seed_sequence.entropy
+        self.rng = np.random.default_rng(self.seed_sequence.spawn(1)[0])
+        print(f'Session seed: {self.seed_sequence.entropy}')
+
         self.fixation_lines = FixationLines(self.win,
                                             self.settings['cloud'].get('aperture_radius'),
                                             color=(1, -1, -1),
                                             **self.settings['fixation_lines'])
+        self.stimulus_registry = StimulusRegistry(self.win)
+
         self.too_late_stimulus = TextStim(self.win, text='Too late!', pos=(0, 0), color=(1, -1, -1), height=0.5)
 
         self.slider_type = slider_type
         self._setup_response_slider(slider_type=slider_type)
 
+        self.stimulus_bank = StimulusBank.from_settings(self.settings)
+
+        if self.stimulus_bank is None:
+            logging.warning('No stimulus bank found for these cloud settings (see stimulus_bank.py), '
+                            'dot layouts will be sampled during trial creation')
+        else:
+            print(f"Using stimulus bank {self.stimulus_bank.bank_id} ({self.stimulus_bank.fn})")
+
+        self.stimulus_array_pool = StimulusArrayPool(self.win,
+                                                     self.settings['cloud'].get('aperture_radius'),
+                                                     self.settings['cloud'].get('dot_radius'))
+
+        self.frame_timing = FrameTimingMonitor(self.win)
+
+        # Started with the experiment (see run())
+        self.mouse_sampler = None
+        self.event_stream = None
+        self.trigger_listener = None
+        self.gaze_sampler = None
+
+        if profile:
+            self.profiler = FrameProfiler()
+            self._instrument(self.profiler)
+        else:
+            self.profiler = None
+
+        if startup_profiler is not None:
+            startup_profiler.mark('session ready')
+
         print("Window colorSpace:", self.win.colorSpace)
 
+    @staticmethod
+    def _instrument(profiler):
+        for trial_class in [TaskTrial, TwoStageTasktrial, TwoSliderTasktrial]:
+            profiler.instrument(trial_class, 'draw', sets_phase=True)
+            profiler.instrument(trial_class, 'get_events', sets_phase=True)
+
+        for stimulus_class in [FixationLines, RadialStimArray, BufferedStimulus, ProbabilityPieChart,
+                               RoundedRectangleWithBorder, ResponseSlider, RangeResponseSlider,
+                               DiscreteResponseSlider, GlyphLabel]:
+            profiler.instrument(stimulus_class, 'draw')
+
 
     def _setup_response_slider(self, slider_type='natural'):
 
@@ -51,6 +133,8 @@ class WTPSession(PylinkEyetrackerSession):
                                             markerColor=self.settings['slider'].get('markerColor'),
                                             borderWidth=self.settings['slider'].get('borderWidth'),
                                             text_height=self.settings['slider'].get('text_height'),
+                                            label_mode=self.settings['slider'].get('label_mode', 'text'),
+                                            rng=self.rng,
                                             slider_type=slider_type)
         elif slider_type == 'two-stage':
 
@@ -67,6 +151,8 @@ class WTPSession(PylinkEyetrackerSession):
                                             markerColor=self.settings['slider'].get('markerColor'),
                                             borderWidth=self.settings['slider'].get('borderWidth'),
                                             text_height=self.settings['slider'].get('text_height'),
+                                            label_mode=self.settings['slider'].get('label_mode', 'text'),
+                                            rng=self.rng,
                                             slider_type='natural',
                                             width_proportion=width_proportion,
                                             )
@@ -84,6 +170,8 @@ class WTPSession(PylinkEyetrackerSession):
                                             markerColor=self.settings['slider'].get('markerColor'),
                                             borderWidth=self.settings['slider'].get('borderWidth'),
                                             text_height=self.settings['slider'].get('text_height'),
+                                            label_mode=self.settings['slider'].get('label_mode', 'text'),
+                                            rng=self.rng,
                                             slider_type='natural')
 
         elif slider_type == 'two-sliders':
@@ -116,6 +204,8 @@ class WTPSession(PylinkEyetrackerSession):
                                             markerColor=self.settings['slider'].get('markerColor'),
                                             borderWidth=self.settings['slider'].get('borderWidth'),
                                             text_height=self.settings['slider'].get('text_height'),
+                                            label_mode=self.settings['slider'].get('label_mode', 'text'),
+                                            rng=self.rng,
                                             slider_type='natural') 
 
 
@@ -126,63 +216,205 @@ class WTPSession(PylinkEyetrackerSession):
 
         self.start_experiment()
 
+        if self.settings['various'].get('stream_events', True):
+            self.event_stream = EventStreamWriter(op.join(self.output_dir, f'{self.output_str}_events.jsonl'),
+                                                  header={'output_str': self.output_str, 'exp_start': self.exp_start,
+                                                          'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                                          'seed': self.settings['seed']})
+            self.event_stream.start()
+            self.event_ledger.stream = self.event_stream
+
+        self.trigger_listener = self._create_trigger_listener()
+        if self.trigger_listener is not None:
+            self.trigger_listener.start()
+
+        if self.settings['interface'].get('record_mouse', False):
+            self.mouse_sampler = self._create_mouse_sampler()
+            self.mouse_sampler.start()
+
         if self.eyetracker_on:
             self.start_recording_eyetracker()
+
+        self.gaze_sampler = self._create_gaze_sampler()
+        if self.gaze_sampler is not None:
+            self.gaze_sampler.start()
+
+        # Time spent in (self-paced) instruction screens does not count towards startup time
+        time_in_instructions = 0.0
+
         for trial in self.trials:
+            if isinstance(trial, DummyWaiterTrial) and (self.time_to_first_trigger is None):
+                self.time_to_first_trigger = time.perf_counter() - self.init_time - time_in_instructions
+                print(f"Ready for first trigger {self.time_to_first_trigger:.2f}s after session start "
+                      f"(peak memory: {get_peak_memory():.0f} MB)")
+
+            trial_start = time.perf_counter()
+            self.current_trial = trial
             trial.run()
 
+            if self.event_stream is not None:
+                # The trial is on disk, even if the stimulus PC crashes later on
+                self.event_stream.sync()
+
+            if self.time_to_first_trigger is None:
+                time_in_instructions += time.perf_counter() - trial_start
+
+        print(f"Peak memory during run: {get_peak_memory():.0f} MB "
+              f"({self.stimulus_array_pool.n_created} dot arrays created)")
+        print(f"Fixation lines: {self.fixation_lines.cost_summary()}")
+        print(f"Stimulus registry: {len(self.stimulus_registry)} shared stimuli "
+              f"({self.stimulus_registry.hits} hits, {self.stimulus_registry.misses} misses)")
+
         self.close()
 
-    def create_trials(self, include_instructions=True):
-        """Create trials."""
+    def close(self):
+        if self.closed:
+            return
+
+        self.frame_timing.finish(self.clock.getTime())
 
-        instruction_trial1 = InstructionTrial(self, 0, self.instructions['instruction1'].format(run=self.settings['run']))
-        dummy_trial = DummyWaiterTrial(self, 0, n_triggers=self.settings['mri']['n_dummy_scans'])
-        
-        self.trials = [instruction_trial1, dummy_trial]
+        if self.mouse_sampler is not None:
+            self.mouse_sampler.stop()
 
-        if not include_instructions:
-            self.trials = self.trials[1:]
+        if self.trigger_listener is not None:
+            self.trigger_listener.stop()
 
-        n_trials = self.settings['task'].get('n_trials')
-        n_probs = len(self.settings['task'].get('probabilities'))
-        n_payoffs = len(self.settings['task']['payoffs'])
+        if self.gaze_sampler is not None:
+            self.gaze_sampler.stop()
 
-        # Make sure n_trials is a multiple of 6 and 4 (or throw error)
-        if n_trials % n_probs != 0:
-            raise ValueError('n_trials should be a multiple of n_probs')
-        if n_trials % n_payoffs != 0:
-            raise ValueError('n_trials should be a multiple of n_payoffs')
+        if self.event_stream is not None:
+            self.event_stream.stop()
+            self.event_ledger.stream = None
 
-        probs = list(self.settings['task']['probabilities'])
-        np.random.shuffle(probs)
+        self.global_log = self.event_ledger.to_dataframe()
+
+        if self.profiler is not None:
+            self.profiler.restore()
+
+        super().close()
+
+        fn = self.frame_timing.save(self.output_dir, self.output_str)
+        print(f"Wrote frame timing report to {fn}")
+
+        if self.profiler is not None:
+            fn = self.profiler.save(self.output_dir, self.output_str)
+            print(f"Wrote frame profile to {fn}")
+
+        if self.mouse_sampler is not None:
+            fn = self.mouse_sampler.save(self.output_dir, self.output_str)
+            print(f"Wrote mouse trajectories to {fn}")
+
+        if self.trigger_listener is not None:
+            fn = self.trigger_listener.save(self.output_dir, self.output_str)
+            print(f"Scanner: {self.trigger_listener.summary()}, written to {fn}")
+
+    def _create_mouse_sampler(self):
+        return MouseSampler(self.mouse, self.clock, self.win)
+
+    def _create_trigger_listener(self):
+        trigger_source = self.settings['mri'].get('trigger_source', 'keyboard')
+        tr = self.settings['mri']['TR']
+
+        if trigger_source == 'keyboard':
+            source = KeyboardTriggerSource.create(self.settings['mri']['sync'], self.clock)
+        elif trigger_source == 'simulated':
+            source = SimulatedTriggerSource(self.clock, tr)
+        elif trigger_source in ['off', False, None]:
+            source = None
+        else:
+            raise ValueError(f'Unknown trigger source: {trigger_source}')
+
+        if source is None:
+            return None
+
+        return TriggerListener(source, tr)
+
+    def _create_gaze_sampler(self):
+        fixation_check = self.settings.get('fixation_check', {})
+        gaze_source = fixation_check.get('gaze_source')
+        rate = 500.
+
+        if gaze_source == 'eyetracker':
+            if not self.eyetracker_on:
+                logging.warning('The fixation check needs the eye tracker, it is turned off')
+                return None
+
+            # From now on, every call to the tracker (also those of exptools2) holds the lock
+            if not isinstance(self.tracker, LockedTracker):
+                self.tracker = LockedTracker(self.tracker, self.tracker_lock)
+
+            source = EyeLinkGazeSource(self.tracker, self.win)
+            rate = self.settings['eyetracker'].get('options', {}).get('sample_rate', rate)
+        elif gaze_source == 'simulated':
+            source = SimulatedGazeSource(self.clock)
+        elif gaze_source in ['off', False, None]:
+            return None
+        else:
+            raise ValueError(f'Unknown gaze source: {gaze_source}')
+
+        return GazeSampler(source, self.clock, rate=rate, radius=fixation_check.get('radius', 1.5),
+                           max_age=fixation_check.get('max_sample_age', .1))
+
+    def get_mouse_pos(self):
+        """ Mouse position as of the last time the window dispatched its events (main thread only). """
+        return self.mouse.getPos()
+
+    def _get_trial_table(self):
+        """ The trials of this run: the rows of the subject's schedule (see `schedule.py`), or drawn now. """
+        schedule_fn = get_schedule_fn(self.settings['subject'])
+
+        if not op.exists(schedule_fn):
+            return make_run_table(self.settings, self.seed_sequence.spawn(1)[0])
+
+        table, info = load_run_table(schedule_fn, self.settings['run'])
+        print(f"Using schedule {schedule_fn} (run {self.settings['run']}, seed {info.get('seed')})")
+
+        if not (np.isin(table['prob'], self.settings['task']['probabilities']).all() and
+                np.isin(table['payoff'], self.settings['task']['payoffs']).all()):
+            raise ValueError(f'Schedule {schedule_fn} does not fit the probabilities and payoffs of these settings')
+
+        if info.get('slider_type') != self.slider_type:
+            logging.warning(f"Schedule {schedule_fn} was made for the {info.get('slider_type')} slider, "
+                            f"the start positions of the marker will be sampled during trial creation")
+            table['start_marker_position'] = np.nan
+
+        bank_id = '' if self.stimulus_bank is None else self.stimulus_bank.bank_id
+
+        if info.get('stimulus_bank', '') != bank_id:
+            logging.warning(f'Schedule {schedule_fn} was made for a different stimulus bank, '
+                            f'the layouts will be sampled during trial creation')
+            table['layout_ix'] = -1
+
+        return table
+
+    def create_trials(self, include_instructions=True):
+        """Create trials.
 
-        payoffs_ = list(self.settings['task']['payoffs'])
+        Trials are only stored as specifications here and constructed right
+        before they are run (see `LazyTrialSequence`).
+        """
 
+        self.trials = LazyTrialSequence()
 
-        trial_nr = 1
+        if include_instructions:
+            self.trials.append(InstructionTrial, self, 0, self.instructions['instruction1'].format(run=self.settings['run']))
 
-        possible_isis = self.settings['durations'].get('isi')
-        isis = possible_isis * int(np.ceil(n_trials / len(possible_isis)))
-        isis = isis[:n_trials]
+        self.trials.append(DummyWaiterTrial, self, 0, n_triggers=self.settings['mri']['n_dummy_scans'])
 
-        for prob in probs:
-            self.trials.append(ProbCueTrial(self, -1, prob))
+        self.trial_table = self._get_trial_table()
 
-            np.random.shuffle(payoffs_)
+        if self.slider_type == 'two-stage':
+            trial_class = TwoStageTasktrial
+        elif self.slider_type == 'two-sliders':
+            trial_class = TwoSliderTasktrial
+        else:
+            trial_class = TaskTrial
 
-            for payoff in payoffs_:
-                
-                if self.slider_type == 'two-stage':
-                    self.trials.append(TwoStageTasktrial(self, trial_nr, jitter=isis[trial_nr-1], payoff=payoff,
-                                             prob=prob))
+        for ix in range(len(self.trial_table)):
+            # Every probability block starts with a cue
+            if (ix == 0) or (self.trial_table['prob'][ix] != self.trial_table['prob'][ix - 1]):
+                self.trials.append(ProbCueTrial, self, -1, float(self.trial_table['prob'][ix]))
 
-                elif self.slider_type == 'two-sliders':
-                    self.trials.append(TwoSliderTasktrial(self, trial_nr, jitter=isis[trial_nr-1], payoff=payoff,
-                                             prob=prob))
-                else:
-                    self.trials.append(TaskTrial(self, trial_nr, jitter=isis[trial_nr-1], payoff=payoff,
-                                                prob=prob))
-                trial_nr += 1
+            self.trials.append_row(trial_class, self.trial_table, ix, self)
 
-        self.trials.append(OutroTrial(session=self))
+        self.trials.append(OutroTrial, session=self)
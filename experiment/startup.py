@@ -0,0 +1,101 @@
+import builtins
+import importlib.util
+import sys
+import time
+
+
+class StartupProfiler(object):
+    """ Times the imports and the steps of starting a session (`--profile_startup`).
+
+    While `start_imports()` is active, every import statement of a module
+    that was not loaded yet is timed. The time spent in a module's own code
+    (without the modules it imports) is summed per top-level package, so the
+    breakdown adds up to the total import time. Only the standard library
+    is imported here, so that everything else is counted.
+    """
+
+    def __init__(self, budget=1.0):
+        self.start = time.perf_counter()
+        self.budget = budget
+        self.imports = {}
+        self.marks = []
+
+        self._import = None
+        self._stack = []
+
+    def start_imports(self):
+        self._import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def stop_imports(self):
+        if self._import is not None:
+            builtins.__import__ = self._import
+            self._import = None
+            self.mark('imports')
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        absolute = name
+
+        if level > 0:
+            try:
+                absolute = importlib.util.resolve_name('.' * level + name, (globals or {}).get('__package__'))
+            except (ImportError, ValueError):
+                return self._import(name, globals, locals, fromlist, level)
+
+        # `from package import module` can load a module even if the package is loaded already
+        modules = [absolute] + [f'{absolute}.{item}' for item in (fromlist or ()) if item != '*']
+        new_modules = [module for module in modules if module not in sys.modules]
+
+        if not new_modules:
+            return self._import(name, globals, locals, fromlist, level)
+
+        self._stack.append(0.0)
+        t0 = time.perf_counter()
+
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            duration = time.perf_counter() - t0
+            children = self._stack.pop()
+
+            if self._stack:
+                self._stack[-1] += duration
+
+            loaded = [module for module in new_modules if module in sys.modules]
+
+            if loaded and (loaded[0] not in self.imports):
+                self.imports[loaded[0]] = (duration, duration - children)
+            elif self._stack:
+                # Nothing new was loaded (e.g., an attribute in `fromlist`): the time is the importer's own
+                self._stack[-1] -= duration
+
+    def mark(self, label):
+        """ Notes the time (since the profiler was made) at which a step of the startup ended. """
+        self.marks.append((label, time.perf_counter() - self.start))
+
+    def report(self, n=10, before_window='session setup'):
+        packages = {}
+        for name, (_, own) in self.imports.items():
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0.0) + own
+
+        lines = ['Startup profile', f'  Import time per package (top {n}):']
+        for package, duration in sorted(packages.items(), key=lambda item: -item[1])[:n]:
+            lines.append(f'    {package:<32}{duration * 1000:8.1f} ms')
+
+        lines.append(f'  Slowest imports (including what they import, top {n}):')
+        for name, (duration, _) in sorted(self.imports.items(), key=lambda item: -item[1][0])[:n]:
+            lines.append(f'    {name:<32}{duration * 1000:8.1f} ms')
+
+        lines.append('  Steps (time since start):')
+        previous = 0.0
+        for label, t in self.marks:
+            lines.append(f'    {label:<32}{t:8.3f} s (+{t - previous:.3f} s)')
+            previous = t
+
+        window = dict(self.marks).get(before_window)
+        if window is not None:
+            status = 'within' if window <= self.budget else 'OVER'
+            lines.append(f'  {window:.3f} s before window creation ({status} the budget of {self.budget:.1f} s)')
+
+        print('\n'.join(lines))
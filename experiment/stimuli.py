@@ -1,101 +1,139 @@
-from psychopy.visual import Circle, Line, Rect, TextStim, Pie
+from psychopy.visual import Circle, Rect, TextStim, Pie, BufferImageStim, ImageStim, ShapeStim, ElementArrayStim
+from psychopy.colors import Color
+from psychopy.tools.monitorunittools import convertToPix
+from PIL import Image
 import numpy as np
 
 range_ = range
 
 class FixationLines(object):
+    """ Fixation cross (and optional outer cross lines) as one ElementArrayStim of oriented bars.
+
+    All lines are drawn with a single draw call; colors and visibility are only
+    sent to the stimulus when they actually change. The counters keep track of
+    how much work that saves.
+    """
 
     def __init__(self, win, circle_radius, color, center_fixation_size=0.25, plus_sign=False, draw_circle=True, draw_outer_cross=True, *args, **kwargs):
 
         win_size = win.size
         max_dimension = np.max(win_size)
 
-        kwargs['colorSpace'] = 'rgb'
+        line_width = kwargs.get('lineWidth', 1.5)
 
         coord = circle_radius * 1.1 * np.cos(np.pi / 4)
 
         # Fixation cross center
-        self.line1 = Line(win, start=(-center_fixation_size, -center_fixation_size),
-                          end=(center_fixation_size, center_fixation_size), lineColor=color, *args, **kwargs)
-        
-        self.line2 = Line(win, start=(-center_fixation_size, center_fixation_size),
-                            end=(center_fixation_size, -center_fixation_size), lineColor=color, *args, **kwargs)
-
-        self.fixation_cross = [self.line1, self.line2]
-
-        self.elements = []
+        segments = [((-center_fixation_size, -center_fixation_size), (center_fixation_size, center_fixation_size)),
+                    ((-center_fixation_size, center_fixation_size), (center_fixation_size, -center_fixation_size))]
+        self.n_cross_lines = len(segments)
 
         if draw_outer_cross:
-            self.line3 = Line(win, start=(-coord, -coord),
-                            end=(-max_dimension, -max_dimension), lineColor=color, *args, **kwargs)
-
-            self.line4 = Line(win, start=(coord, coord),
-                            end=(max_dimension, max_dimension), lineColor=color, *args, **kwargs)
+            segments += [((-coord, -coord), (-max_dimension, -max_dimension)),
+                         ((coord, coord), (max_dimension, max_dimension)),
+                         ((-coord, coord), (-max_dimension, max_dimension)),
+                         ((coord, -coord), (max_dimension, -max_dimension))]
 
-            self.line5 = Line(win, start=(-coord, coord),
-                            end=(-max_dimension, max_dimension), lineColor=color, *args, **kwargs)
+        segments = np.array(segments, dtype=float)
+        starts, ends = segments[:, 0], segments[:, 1]
+        delta = ends - starts
 
-            self.line6 = Line(win, start=(coord, -coord),
-                                end=(max_dimension, -max_dimension), lineColor=color, *args, **kwargs)
+        # Line widths are given in pixels
+        pix_per_unit = np.abs(convertToPix(np.array([1., 0.]), (0, 0), win.units, win)[0])
+        sizes = np.stack((np.sqrt((delta**2).sum(1)), np.full(len(segments), line_width / pix_per_unit)), 1)
 
+        self.colors = np.tile(np.asarray(color, dtype=float), (len(segments), 1))
+        self.opacities = np.ones(len(segments))
+        self.fixation_cross_visible = True
 
-            self.elements += [self.line3, self.line4, self.line5, self.line6]
+        # Element orientations are clockwise
+        self.lines = ElementArrayStim(win, nElements=len(segments), xys=(starts + ends) / 2., sizes=sizes,
+                                      oris=-np.rad2deg(np.arctan2(delta[:, 1], delta[:, 0])),
+                                      elementTex=None, elementMask=None,
+                                      colors=self.colors.copy(), colorSpace='rgb', opacities=self.opacities.copy())
 
         if draw_circle:
-            self.aperture = Circle(win, radius=circle_radius * 1.1, fillColor=(0, 0, 0), lineColor=color, lineWidth=kwargs['lineWidth'])
-            self.elements.append(self.aperture)
+            self.aperture = Circle(win, radius=circle_radius * 1.1, fillColor=(0, 0, 0), lineColor=color, lineWidth=line_width)
+        else:
+            self.aperture = None
+
+        self.n_frames = 0
+        self.n_draw_calls = 0
+        self.n_color_requests = 0
+        self.n_color_updates = 0
 
 
     def draw(self, draw_fixation_cross=True):
 
-        
-        if draw_fixation_cross:
-            for line in self.fixation_cross:
-                line.draw()
+        self.n_frames += 1
+
+        if draw_fixation_cross != self.fixation_cross_visible:
+            self.opacities[:self.n_cross_lines] = float(draw_fixation_cross)
+            self.lines.opacities = self.opacities.copy()
+            self.fixation_cross_visible = draw_fixation_cross
 
-        for line in self.elements:
-            line.draw()
+        if self.aperture is not None:
+            self.aperture.draw()
+            self.n_draw_calls += 1
+
+        if self.opacities.any():
+            self.lines.draw()
+            self.n_draw_calls += 1
 
     def setColor(self, color, fixation_cross_only=False):
 
-        for line in self.fixation_cross:
-            line.lineColor = color
+        self.n_color_requests += 1
+
+        color = np.asarray(color, dtype=float)
+        n_lines = self.n_cross_lines if fixation_cross_only else len(self.colors)
+
+        if not (self.colors[:n_lines] == color).all():
+            self.colors[:n_lines] = color
+            self.lines.colors = self.colors.copy()
+            self.n_color_updates += 1
+
+        if (not fixation_cross_only) and (self.aperture is not None):
+            self.aperture.lineColor = color
+
+    def cost_summary(self):
+        """ Draw calls and color updates, compared to drawing (and recoloring) every line separately. """
+        n_shapes = len(self.colors) + (self.aperture is not None)
+        return (f'{self.n_draw_calls} draw calls over {self.n_frames} frames (one per shape: up to {self.n_frames * n_shapes}), '
+                f'{self.n_color_updates} of {self.n_color_requests} color changes applied')
+
+def _rounded_rectangle_vertices(width, height, corner_radius, n_corner_vertices=16):
+    """ Outline of a rounded rectangle centered on (0, 0), as one vertex array. """
+
+    corner_radius = np.clip(corner_radius, 0, min(width, height) / 2.)
+    x, y = width / 2. - corner_radius, height / 2. - corner_radius
+
+    vertices = []
+    for (center_x, center_y), start_angle in zip([(x, y), (-x, y), (-x, -y), (x, -y)], [0, 90, 180, 270]):
+        angles = np.deg2rad(np.linspace(start_angle, start_angle + 90, n_corner_vertices))
+        vertices.append(np.stack((center_x + np.cos(angles) * corner_radius,
+                                  center_y + np.sin(angles) * corner_radius), 1))
+
+    return np.concatenate(vertices)
 
-        if not fixation_cross_only:
-            for line in self.elements:
-                line.lineColor = color
 
 class RoundedRectangle(object):
+    """ Rounded rectangle drawn as a single ShapeStim; moving it only changes its translation. """
 
     def __init__(self, win, pos, width, height, corner_radius, color):
 
-        x, y = pos
-
         self.width = width
         self.height = height
         self.corner_radius = corner_radius
 
-        self.border_corners = [
-            Circle(win, radius=corner_radius, pos=[x - width/2 + corner_radius, y + height/2 - corner_radius], fillColor=color),
-            Circle(win, radius=corner_radius, pos=[x + width/2 - corner_radius, y + height/2 - corner_radius], fillColor=color),
-            Circle(win, radius=corner_radius, pos=[x - width/2 + corner_radius, y - height/2 + corner_radius], fillColor=color),
-            Circle(win, radius=corner_radius, pos=[x + width/2 - corner_radius, y - height/2 + corner_radius], fillColor=color)
-        ]
-
-        self.border_sides = [
-            Rect(win, width=width-2*corner_radius, height=corner_radius*2, pos=[x, y - height/2 + corner_radius], fillColor=color,),
-            Rect(win, width=width-2*corner_radius, height=corner_radius*2, pos=[x, y + height/2 - corner_radius], fillColor=color,),
-            Rect(win, width=corner_radius*2, height=height-2*corner_radius, pos=[x - width/2 + corner_radius, y], fillColor=color,),
-            Rect(win, width=corner_radius*2, height=height-2*corner_radius, pos=[x + width/2 - corner_radius, y], fillColor=color,)
-        ]
-
-        self.inner_rectangle = Rect(win, width=width-2*corner_radius, height=height-2*corner_radius, pos=[x, y], fillColor=color)
+        self.shape = ShapeStim(win, vertices=_rounded_rectangle_vertices(width, height, corner_radius),
+                               pos=pos, fillColor=color, lineColor=None, lineWidth=0, closeShape=True)
+
+        self._pos = pos
+        self._color = None
         self.color = color
 
     def draw(self):
-        for shape in self.border_corners + self.border_sides:
-            shape.draw()
-        self.inner_rectangle.draw()
+        self.shape.draw()
     
     @property
     def pos(self):
@@ -107,21 +145,7 @@ class RoundedRectangle(object):
         self.update_position()
 
     def update_position(self):
-
-        x, y = self._pos
-
-        self.border_corners[0].pos = [x - self.width/2 + self.corner_radius, y + self.height/2 - self.corner_radius]
-        self.border_corners[1].pos = [x + self.width/2 - self.corner_radius, y + self.height/2 - self.corner_radius]
-        self.border_corners[2].pos = [x - self.width/2 + self.corner_radius, y - self.height/2 + self.corner_radius]
-        self.border_corners[3].pos = [x + self.width/2 - self.corner_radius, y - self.height/2 + self.corner_radius]
-
-        self.border_sides[0].pos = [x, y - self.height/2 + self.corner_radius]
-        self.border_sides[1].pos = [x, y + self.height/2 - self.corner_radius]
-        self.border_sides[2].pos = [x - self.width/2 + self.corner_radius, y]
-        self.border_sides[3].pos = [x + self.width/2 - self.corner_radius, y]
-
-        self.inner_rectangle.pos = [x, y]
-        self.inner_rectangle.pos = [x, y]
+        self.shape.pos = self._pos
 
     @property
     def color(self):
@@ -129,8 +153,8 @@ class RoundedRectangle(object):
 
     @color.setter
     def color(self, value):
-        for shape in self.border_corners + self.border_sides + [self.inner_rectangle]:
-            shape.fillColor = value
+        if (self._color is None) or not np.array_equal(value, self._color):
+            self.shape.fillColor = value
 
         self._color = value
 
@@ -142,6 +166,7 @@ class RoundedRectangleWithBorder(object):
         self.outer_rectangle = RoundedRectangle(win, pos, width, height, corner_radius, outer_color)
         self.inner_rectangle = RoundedRectangle(win, pos, width-borderWidth*2, height-borderWidth*2, adjusted_corner_radius, inner_color)
         self.width = width
+        self._pos = pos
 
     def draw(self):
         self.outer_rectangle.draw()
@@ -170,6 +195,55 @@ class RoundedRectangleWithBorder(object):
         self.inner_rectangle.color = value
 
 
+class GlyphLabel(object):
+    """ Drop-in replacement for a single-line TextStim, composed from pre-rendered glyphs.
+
+    Every character is laid out and rasterized once; changing the text only
+    moves glyphs around. Only the characters given at construction are supported.
+    """
+
+    def __init__(self, win, text='', pos=(0.0, 0.0), height=0.5, color=(1, 1, 1), units='deg',
+                 characters='0123456789$.- '):
+
+        pix_per_unit = np.abs(convertToPix(np.array([1., 0.]), (0, 0), units, win)[0])
+
+        self.glyphs = {}
+        self.advances = {}
+
+        for character in characters:
+            self.glyphs[character] = TextStim(win, text=character, color=color, units=units, height=height,
+                                              anchorHoriz='left')
+            self.advances[character] = self.glyphs[character].boundingBox[0] / pix_per_unit
+
+        self._pos = pos
+        self.text = text
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        offsets = np.cumsum([0.] + [self.advances[character] for character in value])
+        # Center the label on its position
+        self._layout = [(self.glyphs[character], offset - offsets[-1] / 2.)
+                        for character, offset in zip(value, offsets[:-1]) if character != ' ']
+        self._text = value
+
+    @property
+    def pos(self):
+        return self._pos
+
+    @pos.setter
+    def pos(self, value):
+        self._pos = value
+
+    def draw(self):
+        for glyph, offset in self._layout:
+            glyph.pos = (self._pos[0] + offset, self._pos[1])
+            glyph.draw()
+
+
 class ResponseSlider(object):
 
     def __init__(self, win, position, length, height, color, borderColor, range, marker_position, show_marker=False,
@@ -179,9 +253,12 @@ class ResponseSlider(object):
                  slider_type='natural',
                  slider_width=None,
                  borderWidth=0.05,
+                 label_mode='text',
+                 rng=None,
                  *args, **kwargs):
 
         assert slider_type in ['natural', 'log']
+        assert label_mode in ['text', 'glyphs']
         self.range = range
         self.height = height
 
@@ -189,10 +266,16 @@ class ResponseSlider(object):
         self.show_number = show_number
 
         if self.show_number:
-            self.number = TextStim(win, text='0', pos=(position[0], position[1] - height*1.5), color=(1, 1, 1), units='deg', height=text_height)
+            if label_mode == 'text':
+                self.number = TextStim(win, text='0', pos=(position[0], position[1] - height*1.5), color=(1, 1, 1), units='deg', height=text_height)
+            else:
+                self.number = GlyphLabel(win, text='0', pos=(position[0], position[1] - height*1.5), color=(1, 1, 1), units='deg', height=text_height)
+            self._number_text = '0'
 
         if marker_position is None:
-            marker_position = np.random.randint(range[0], range[1]+1) 
+            if rng is None:
+                rng = np.random.default_rng()
+            marker_position = rng.integers(range[0], range[1]+1)
        
         if markerColor is None:
             markerColor = color
@@ -220,11 +303,17 @@ class ResponseSlider(object):
 
             if self.show_number:
                 if self.slider_type == 'natural':
-                    self.number.text = f'${self.marker_position:.2f}'
+                    self.set_number_text(f'${self.marker_position:.2f}')
                 elif self.slider_type == 'log':
-                    self.number.text = f'${self.marker_position:.2f}'
+                    self.set_number_text(f'${self.marker_position:.2f}')
                 self.number.draw()
 
+    def set_number_text(self, text):
+        # Changing the text of a TextStim lays it out (and uploads it) again, so only do so if it changed
+        if text != self._number_text:
+            self.number.text = text
+            self._number_text = text
+
     def setMarkerPosition(self, number):
         # Clip the number to stay within the valid range
         number = np.clip(number, self.range[0], self.range[1])
@@ -276,6 +365,17 @@ class ResponseSlider(object):
         else:
             raise ValueError("Unsupported slider type")
 
+    def markerToMousePosition(self, number):
+        """ The mouse position for which `mouseToMarkerPosition` gives `number`. """
+        number = np.clip(number, self.range[0], self.range[1])
+
+        if self.slider_type == 'log':
+            fraction = (np.log10(number) - np.log10(self.range[0])) / (np.log10(self.range[1]) - np.log10(self.range[0]))
+        else:
+            fraction = (number - self.range[0]) / (self.range[1] - self.range[0])
+
+        return self.bar.pos[0] - self.bar.width / 2. + fraction * self.bar.width
+
 
     @property
     def pos(self):
@@ -340,7 +440,7 @@ class RangeResponseSlider(ResponseSlider):
                 lower_range = self.marker_position - self.width_proportion * (self.range_[1] - self.range_[0]) / 2
                 upper_range = self.marker_position + self.width_proportion * (self.range_[1] - self.range_[0]) / 2
 
-                self.number.text = f'${lower_range:.2f} - ${upper_range:.2f}'
+                self.set_number_text(f'${lower_range:.2f} - ${upper_range:.2f}')
                 self.number.draw()
 
 class DiscreteResponseSlider(object):
@@ -382,7 +482,8 @@ class DiscreteResponseSlider(object):
         self.height = height
 
         self.bar = Rect(win, width=length, height=height, pos=position, color=color, lineColor=borderColor, lineWidth=self.borderWidth*10)
-        self.marker = Rect(win, width=self.slider_width, height=height, pos=position, color=markerColor, lineColor=borderColor, lineWidth=self.borderWidth*10)
+        self.marker = Rect(win, width=self.slider_width, height=height, pos=position, fillColor=markerColor, lineColor=borderColor, lineWidth=self.borderWidth)
+        self.marker_bin = None
 
 
         self.text_stimuli = []
@@ -396,25 +497,28 @@ class DiscreteResponseSlider(object):
 
             self.text_stimuli.append(text)
 
+        # The bar and bin labels never change, so they are rendered into a texture once (with a
+        # transparent background, so that the fixation lines stay visible). This happens here (during session setup), as rendering clears the back buffer.
+        self.static_layer = BufferedStimulus(win, [self.bar] + self.text_stimuli,
+                                             (length + 4 * self.text_height, height + 4 * self.text_height),
+                                             pos=(position[0], position[1] + self.text_height), transparent=True)
+        self.static_layer.render()
+
 
     def draw(self):
-        self.bar.draw()
+        self.static_layer.draw()
 
         if self.show_marker:
             self.marker.draw()
 
-        for stimulus in self.text_stimuli:
-            stimulus.draw()
-
     def update_marker_position(self, number):
         number = np.clip(number, self.range[0], self.range[1])
         closest_bin = np.digitize(number, self.bins) - 1
         self.marker_position = self.bins[closest_bin]
-        self.marker.pos = (self.bar.pos[0] + (closest_bin + 0.5) * self.slider_width - self.bar.width / 2., self.bar.pos[1])
-        self.marker.fillColor = self.markerColor
-        self.marker.lineColor = self.borderColor
-        self.marker.lineWidth = self.borderWidth
-        self.marker.draw()
+
+        if closest_bin != self.marker_bin:
+            self.marker.pos = (self.bar.pos[0] + (closest_bin + 0.5) * self.slider_width - self.bar.width / 2., self.bar.pos[1])
+            self.marker_bin = closest_bin
 
     def setMarkerPosition(self, number):
         self.update_marker_position(number)
@@ -426,6 +530,12 @@ class DiscreteResponseSlider(object):
         self.update_marker_position(number)
         return self.marker_position
 
+    def markerToMousePosition(self, number):
+        """ The mouse position at the middle of the bin of `number` (markers give the lower edge of their bin). """
+        number = np.clip(number, self.range[0], self.range[1])
+        closest_bin = min(np.digitize(number, self.bins) - 1, self.n_steps - 1)
+        return self.bar.pos[0] + (closest_bin + 0.5) * self.slider_width - self.bar.width / 2.
+
 class ProbabilityPieChart(object):
 
     def __init__(self, window, prob, size, prefix='',
@@ -455,3 +565,125 @@ class ProbabilityPieChart(object):
         
         if self.include_text:
             self.text.draw()
+
+
+class BufferedStimulus(object):
+    """ Renders a group of static stimuli once into a texture, so that drawing them is a single blit.
+
+    `render()` draws the stimuli into the (cleared) back buffer and captures the
+    rectangle of the given size around `pos`, so it should be called before
+    anything else is drawn in that frame. `release()` frees the texture.
+
+    The capture is opaque (the window color fills the rectangle), unless
+    `transparent` is set: the stimuli are then captured over black and over
+    white, which gives the opacity of every pixel, so that whatever is drawn
+    below the texture stays visible.
+    """
+
+    def __init__(self, win, stimuli, size, pos=(0.0, 0.0), mask=None, transparent=False):
+        self.win = win
+        self.stimuli = stimuli
+        self.size = size
+        self.pos = pos
+        self.mask = mask
+        self.transparent = transparent
+        self.buffer = None
+
+    def render(self):
+        if self.buffer is not None:
+            return
+
+        half_win_size = np.array(self.win.size) / 2.
+        center = convertToPix(np.zeros(2), self.pos, self.win.units, self.win)
+        half_size = np.abs(convertToPix(np.array(self.size) / 2., (0, 0), self.win.units, self.win))
+
+        # Snap to whole pixels, so the texture maps 1:1 to the screen
+        lower, upper = np.floor(center - half_size), np.ceil(center + half_size)
+        (left, bottom), (right, top) = lower / half_win_size, upper / half_win_size
+
+        rect = (left, top, right, bottom)
+        pos = (lower + upper) / 2.
+
+        if self.transparent:
+            self.buffer = self._render_transparent(rect, pos)
+            return
+
+        # BufferImageStim positions are in pixels, unless the window uses norm units
+        if self.win.units == 'norm':
+            pos = pos / half_win_size
+
+        self.buffer = BufferImageStim(self.win, stim=self.stimuli, rect=rect, pos=pos, mask=self.mask,
+                                      interpolate=False)
+
+    def _capture(self, rect, background):
+        color = self.win.color
+        self.win.color = Color(background)
+        self.win.clearBuffer()
+
+        for stimulus in self.stimuli:
+            stimulus.draw()
+
+        region = self.win._getRegionOfFrame(buffer='back', rect=rect)
+
+        self.win.color = color
+        self.win.clearBuffer()
+
+        return np.asarray(region.convert('RGB'), dtype=float) / 255.
+
+    def _render_transparent(self, rect, pos):
+        over_black = self._capture(rect, 'black')
+        over_white = self._capture(rect, 'white')
+
+        # A pixel with opacity a and color c is a * c over black and a * c + (1 - a) over white
+        alpha = np.clip(1. - (over_white - over_black).mean(axis=-1), 0., 1.)
+        rgb = np.clip(over_black / np.maximum(alpha, 1. / 255.)[..., np.newaxis], 0., 1.)
+
+        rgba = np.round(np.dstack([rgb, alpha]) * 255.).astype(np.uint8)
+        image = Image.fromarray(rgba, 'RGBA')
+
+        return ImageStim(self.win, image=image, units='pix', pos=pos, size=image.size, mask=self.mask,
+                         interpolate=False)
+
+    def draw(self):
+        if self.buffer is None:
+            for stimulus in self.stimuli:
+                stimulus.draw()
+        else:
+            self.buffer.draw()
+
+    def release(self):
+        if self.buffer is not None:
+            self.buffer.clearTextures()
+            self.buffer = None
+
+
+class StimulusRegistry(object):
+    """ Hands out shared instances of static stimuli, so that every distinct pie chart or
+    text is only created (and laid out) once per session. Users should not modify them. """
+
+    def __init__(self, win):
+        self.win = win
+        self.stimuli = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key, create):
+        if key in self.stimuli:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.stimuli[key] = create()
+
+        return self.stimuli[key]
+
+    def get_pie_chart(self, prob, size, pos=(0.0, 0.0), include_text=True):
+        key = ('pie_chart', prob, size, tuple(pos), include_text)
+        return self._get(key, lambda: ProbabilityPieChart(self.win, prob, size, pos=pos, include_text=include_text))
+
+    def get_text(self, text, height, wrapWidth=None, color=(1, 1, 1), pos=(0.0, 0.0)):
+        key = ('text', text, height, wrapWidth, tuple(color), tuple(pos))
+        return self._get(key, lambda: TextStim(self.win, text, pos=pos, height=height, wrapWidth=wrapWidth,
+                                               color=color))
+
+    def __len__(self):
+        return len(self.stimuli)
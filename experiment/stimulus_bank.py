@@ -0,0 +1,164 @@
+import argparse
+import hashlib
+import os
+import os.path as op
+import struct
+import zipfile
+import numpy as np
+import yaml
+from utils import _sample_dot_positions
+
+
+def get_stimulus_bank_fn(cloud_settings):
+    """ Default location of the bank that belongs to a `cloud` configuration. """
+
+    if cloud_settings.get('stimulus_bank') is not None:
+        return op.join(op.dirname(__file__), cloud_settings['stimulus_bank'])
+
+    return op.join(op.dirname(__file__), 'stimulus_banks',
+                   f"cloud_aperture-{cloud_settings['aperture_radius']}_dot-{cloud_settings['dot_radius']}.npz")
+
+
+def _memmap_npz_member(fn, key):
+    """ Memory-maps an array that is stored uncompressed inside an .npz file. """
+
+    with zipfile.ZipFile(fn) as zf:
+        info = zf.getinfo(f'{key}.npy')
+        compressed = info.compress_type != zipfile.ZIP_STORED
+
+    if compressed:
+        return np.load(fn)[key]
+
+    with open(fn, 'rb') as f:
+        # Skip the local zip header to get to the .npy data
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', f.read(4))
+        f.seek(name_length + extra_length, os.SEEK_CUR)
+
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    return np.memmap(fn, dtype=dtype, mode='r', shape=shape, offset=offset, order='F' if fortran_order else 'C')
+
+
+class StimulusBank(object):
+    """ Precomputed dot layouts for every payoff of one `cloud` configuration.
+
+    Layouts for n dots are stored under `n_dots-{n}` with shape (n_layouts, n, 2)
+    and are memory-mapped, so opening a bank is (nearly) free. The bank id is a
+    hash over all layouts and the cloud parameters.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+        with np.load(fn) as bank:
+            self.bank_id = str(bank['bank_id'])
+            self.aperture_radius = float(bank['aperture_radius'])
+            self.dot_radius = float(bank['dot_radius'])
+            self.seed = int(bank['seed'])
+            keys = [key for key in bank.files if key.startswith('n_dots-')]
+
+        self.layouts = {int(key[len('n_dots-'):]): _memmap_npz_member(fn, key) for key in keys}
+
+    @classmethod
+    def from_settings(cls, settings):
+        """ Opens the bank for the current `cloud` settings, or returns None if it has not been generated. """
+        fn = get_stimulus_bank_fn(settings['cloud'])
+
+        if not op.exists(fn):
+            return None
+
+        bank = cls(fn)
+
+        if not np.isclose(bank.aperture_radius, settings['cloud']['aperture_radius']) or \
+                not np.isclose(bank.dot_radius, settings['cloud']['dot_radius']):
+            raise ValueError(f'Stimulus bank {fn} was made for a different cloud configuration')
+
+        return bank
+
+    @property
+    def n_layouts(self):
+        return min(layouts.shape[0] for layouts in self.layouts.values())
+
+    def has_layouts(self, n_dots):
+        return n_dots in self.layouts
+
+    def get_layout(self, n_dots, layout_ix):
+        if n_dots not in self.layouts:
+            raise KeyError(f'Stimulus bank {self.fn} has no layouts for {n_dots} dots')
+
+        return np.array(self.layouts[n_dots][layout_ix], dtype=float)
+
+    def verify(self):
+        """ Recomputes the content hash and compares it to the stored bank id. """
+        return get_bank_id(self.layouts, self.aperture_radius, self.dot_radius) == self.bank_id
+
+
+def get_bank_id(layouts, aperture_radius, dot_radius):
+    sha = hashlib.sha1()
+    sha.update(f'aperture_radius-{aperture_radius}_dot_radius-{dot_radius}'.encode())
+
+    for n_dots in sorted(layouts):
+        sha.update(f'n_dots-{n_dots}'.encode())
+        sha.update(np.ascontiguousarray(layouts[n_dots], dtype=np.float32).tobytes())
+
+    return sha.hexdigest()[:12]
+
+
+def make_stimulus_bank(payoffs, aperture_radius, dot_radius, n_layouts=1000, seed=0):
+    """ Samples `n_layouts` valid dot layouts for every payoff. """
+    n_dots_list = sorted(set(payoffs))
+
+    layouts = {}
+    # Every layout gets its own generator, so layouts can be (re)generated independently of each other
+    for n_dots, seed_sequence in zip(n_dots_list, np.random.SeedSequence(seed).spawn(len(n_dots_list))):
+        layouts[n_dots] = np.array([_sample_dot_positions(n_dots, aperture_radius, dot_radius,
+                                                          rng=np.random.default_rng(layout_seed))
+                                    for layout_seed in seed_sequence.spawn(n_layouts)],
+                                   dtype=np.float32).reshape(n_layouts, n_dots, 2)
+
+    return layouts, get_bank_id(layouts, aperture_radius, dot_radius)
+
+
+def main(settings='default', n_layouts=1000, seed=0, output=None):
+
+    settings_fn = op.join(op.dirname(__file__), 'settings', f'{settings}.yml')
+
+    with open(settings_fn, 'r') as f:
+        settings = yaml.safe_load(f)
+
+    aperture_radius = settings['cloud']['aperture_radius']
+    dot_radius = settings['cloud']['dot_radius']
+
+    layouts, bank_id = make_stimulus_bank(settings['task']['payoffs'], aperture_radius, dot_radius,
+                                          n_layouts=n_layouts, seed=seed)
+
+    if output is None:
+        output = get_stimulus_bank_fn(settings['cloud'])
+
+    if op.dirname(output) and not op.exists(op.dirname(output)):
+        os.makedirs(op.dirname(output))
+
+    # Stored uncompressed, so that the layouts can be memory-mapped
+    np.savez(output, bank_id=bank_id, aperture_radius=aperture_radius, dot_radius=dot_radius, seed=seed,
+             **{f'n_dots-{n_dots}': positions for n_dots, positions in layouts.items()})
+
+    print(f'Wrote stimulus bank {bank_id} ({n_layouts} layouts for {sorted(layouts)} dots) to {output}')
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--settings', type=str, help='Settings label', default='default')
+    argparser.add_argument('--n_layouts', type=int, help='Number of layouts per payoff', default=1000)
+    argparser.add_argument('--seed', type=int, help='Random seed', default=0)
+    argparser.add_argument('--output', type=str, help='Output file (default: derived from the cloud settings)',
+                           default=None)
+
+    args = argparser.parse_args()
+
+    main(settings=args.settings, n_layouts=args.n_layouts, seed=args.seed, output=args.output)
@@ -1,14 +1,41 @@
 import argparse
-import os.path as op
-from psychopy.visual import Slider
-from psychopy import event
-from exptools2.core import PylinkEyetrackerSession, Trial
-from utils import _create_stimulus_array, get_output_dir_str, DummyWaiterTrial, OutroTrial, get_settings
-from instruction import InstructionTrial
-from stimuli import FixationLines, ResponseSlider, ProbabilityPieChart
-import numpy as np
-import logging
-from psychopy.visual import Line, Rect, TextStim
+from startup import StartupProfiler
+
+
+def get_argparser():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('subject', type=str, help='Subject nr')
+    argparser.add_argument('session', type=str, help='Session')
+    argparser.add_argument('run', type=int, help='Run')
+    argparser.add_argument('--settings', type=str, help='Settings label', default='default')
+    argparser.add_argument('--calibrate_eyetracker', action='store_true', dest='calibrate_eyetracker')
+    argparser.add_argument('--profile', action='store_true', help='Write per-phase draw/get_events timings')
+    argparser.add_argument('--profile_startup', action='store_true',
+                           help='Print an import time breakdown and the time until the window is created')
+    argparser.add_argument('--slider_type', type=str, default='natural', help='Response bar type', choices=['natural', 'log', 'two-stage', 'two-sliders'])
+    argparser.add_argument('--seed', type=int, default=None, help='Session seed (default: random, it is logged)')
+    argparser.add_argument('--fixation_check', type=str, default=None, choices=['eyetracker', 'simulated'],
+                           help='Wait for stable fixation before the stimulus (default: fixation_check.gaze_source)')
+
+    return argparser
+
+
+startup_profiler = None
+
+if __name__ == "__main__":
+    # Parsed before the imports below (which load psychopy and exptools2), so --help returns at once
+    args = get_argparser().parse_args()
+
+    if args.profile_startup:
+        startup_profiler = StartupProfiler()
+        startup_profiler.start_imports()
+
+import numpy as np  # noqa: E402
+from logged_trial import LoggedTrial  # noqa: E402
+from instruction import InstructionTrial  # noqa: E402
+from stimuli import BufferedStimulus  # noqa: E402
+from response import ResponseController  # noqa: E402
+from utils import get_output_dir_str, get_settings  # noqa: E402
 
 class ProbCueTrial(InstructionTrial):
 
@@ -17,29 +44,36 @@ class ProbCueTrial(InstructionTrial):
         txt = session.instructions['prob_cue'].format(prob=int(prob*100))
         bottom_txt = ""
 
-        self.prob_cue = ProbabilityPieChart(session.win,
-                                            prob,
-                                            session.settings['prob_cue'].get('cue_size'),
-                                            pos=(0, -1.))
+        self.prob_cue = session.stimulus_registry.get_pie_chart(prob,
+                                                                session.settings['prob_cue'].get('cue_size'),
+                                                                pos=(0, -1.))
 
         super().__init__(session, trial_nr, txt, bottom_txt=bottom_txt,
                         phase_durations=[session.settings['durations']['cue_trials']],
+                         txt_pos=(0, 1.),
                          **kwargs)
 
-        self.text.pos = (0, 1.)
-
     def draw(self):
         super().draw()
         self.prob_cue.draw()
 
     def get_events(self):
-        Trial.get_events(self)
+        if hasattr(self.session.trials, 'prefetch'):
+            self.session.trials.prefetch()
+
+        LoggedTrial.get_events(self)
 
 
-class TaskTrial(Trial):
+class TaskTrial(LoggedTrial):
     def __init__(self, session, trial_nr, phase_durations=None,
                 jitter=1,
-                payoff=15, prob=0.55, **kwargs):
+                payoff=15, prob=0.55, layout_ix=None, start_marker_position=None, seed=None, **kwargs):
+
+        if seed is None:
+            seed = int(session.rng.integers(2**31 - 1))
+
+        # The trial's own generator: its stimuli do not depend on when (or where) the trial is constructed
+        self.rng = np.random.default_rng(seed)
 
         if phase_durations is None:
             phase_durations = [session.settings['durations']['first_fixation'], # Red fixation
@@ -50,12 +84,44 @@ class TaskTrial(Trial):
                             session.settings['durations']['feedback'], # Feedback
                             0.0] #Spillover
 
-        self.total_duration = np.sum(phase_durations)
-
         self.stimulus_phase = [2]
+        self.jitter_phase = 3
         self.response_phase = 4
         self.feedback_phase = 5
 
+        # Optionally, the phase before the stimulus goes on until fixation is stable (see check_fixation())
+        self.gaze_sampler = session.gaze_sampler
+        self.gate_phase = self.stimulus_phase[0] - 1
+
+        # Optionally, the fixation, cue and stimulus phases last an integer number of frames
+        self.frame_locked_phases = {}
+        self.frame_counts = {}
+
+        if session.settings['durations'].get('frame_locked', False):
+            frame_period = session.frame_timing.frame_period
+
+            for phase in [0, 1] + self.stimulus_phase:
+                if (self.gaze_sampler is not None) and (phase == self.gate_phase):
+                    continue
+
+                n_frames = int(np.round(phase_durations[phase] / frame_period))
+
+                if n_frames > 0:
+                    self.frame_locked_phases[phase] = n_frames
+                    self.frame_counts[phase] = 0
+                    # The phase is ended by frame count; the timer is only a fallback (e.g., for dropped frames)
+                    phase_durations[phase] = (n_frames + .5) * frame_period
+
+        if self.gaze_sampler is not None:
+            fixation_check = session.settings['fixation_check']
+            self.min_fixation_duration = fixation_check.get('min_duration', .2)
+            self.max_fixation_wait = fixation_check.get('max_wait', 2.)
+            self.gate_duration = phase_durations[self.gate_phase]
+            # The phase is ended by check_fixation(); the timer ends it when fixation is not stable in time
+            phase_durations[self.gate_phase] += self.max_fixation_wait
+
+        self.total_duration = np.sum(phase_durations)
+
         phase_names = ['fixation1', 'prob_cue', 'stimulus', 'jitter', 'response', 'feedback', 'iti']
 
         super().__init__(session, trial_nr, phase_durations, phase_names=phase_names, **kwargs)
@@ -63,33 +129,165 @@ class TaskTrial(Trial):
         self.parameters['prob'] = prob
         self.parameters['payoff'] = payoff
         self.parameters['jitter'] = jitter
-        self.stimulus_array = _create_stimulus_array(self.session.win, self.parameters['payoff'],
-                                                     self.session.settings['cloud'].get('aperture_radius'),
-                                                     self.session.settings['cloud'].get('dot_radius'),)
+        self.parameters['seed'] = seed
+
+        stimulus_bank = self.session.stimulus_bank
+
+        if (stimulus_bank is not None) and stimulus_bank.has_layouts(payoff):
+            # Schedules mark layouts that are left to the trial with -1
+            if (layout_ix is None) or (layout_ix < 0):
+                layout_ix = int(self.rng.integers(stimulus_bank.n_layouts))
 
-        self.prob_cue = ProbabilityPieChart(self.session.win, self.parameters['prob'],
-                                            self.session.settings['prob_cue'].get('fixation_size'),
-                                            include_text=False)
+            self.parameters['stimulus_bank'] = stimulus_bank.bank_id
+            self.parameters['layout_ix'] = layout_ix
+            xys = stimulus_bank.get_layout(payoff, layout_ix)
+        else:
+            xys = None
+
+        self.stimulus_array = self.session.stimulus_array_pool.acquire(self.parameters['payoff'], xys=xys, rng=self.rng)
+
+        self.prob_cue = self.session.stimulus_registry.get_pie_chart(self.parameters['prob'],
+                                                                     self.session.settings['prob_cue'].get('fixation_size'),
+                                                                     include_text=False)
 
         if self.session.settings['task'].get('show_prob_during_payoff'):
-            self.prob_fixation = ProbabilityPieChart(self.session.win, self.parameters['prob'],
-                                                self.session.settings['prob_cue'].get('fixation_size'),
-                                                include_text=False)
+            self.prob_fixation = self.session.stimulus_registry.get_pie_chart(self.parameters['prob'],
+                                                                              self.session.settings['prob_cue'].get('fixation_size'),
+                                                                              include_text=False)
+            buffered_stimuli = [self.prob_fixation, self.stimulus_array]
+        else:
+            buffered_stimuli = [self.stimulus_array]
+
+        # Pre-rendered during the fixation and probability cue phases
+        aperture_diameter = self.session.settings['cloud'].get('aperture_radius') * 2
+        self.stimulus_buffer = BufferedStimulus(self.session.win, buffered_stimuli,
+                                                (aperture_diameter, aperture_diameter), mask='circle')
+
+        if (start_marker_position is None) or np.isnan(start_marker_position):
+            start_marker_position = self.sample_start_marker_position()
+
+        self.parameters['start_marker_position'] = start_marker_position
+
+        self.input_mode = self.session.settings['interface'].get('input_mode', 'absolute')
+        self.align_to_volumes = self.session.settings['mri'].get('align_to_volumes', False)
+
+        if hasattr(self.session, 'response_slider'):
+            self.response_controller = ResponseController(self.session, self.session.response_slider,
+                                                          mode=self.input_mode)
+
+    def sample_start_marker_position(self):
+        return int(self.rng.integers(self.session.settings['slider']['range'][0],
+                                     self.session.settings['slider']['range'][1] + 1))
+
+    @property
+    def responded(self):
+        return self.response_controller.committed
+
+    def log_phase_info(self, phase=None):
+        super().log_phase_info(phase=phase)
+        self.session.frame_timing.phase_started(self, self.phase if phase is None else phase,
+                                                self.session.clock.getTime())
+
+    def run(self):
+        mouse_sampler = self.session.mouse_sampler
+
+        if mouse_sampler is not None:
+            first_sample = mouse_sampler.n_samples
+
+        super().run()
+
+        if mouse_sampler is not None:
+            mouse_sampler.record_trial(self.trial_nr, first_sample)
+
+        self.stimulus_buffer.release()
+        self.session.stimulus_array_pool.release(self.stimulus_array)
+
+    def prefetch_next_trial(self):
+        """ Constructs the next trial while nothing time-critical is on screen. """
+        if (self.phase in [self.jitter_phase, len(self.phase_durations) - 1]) and hasattr(self.session.trials, 'prefetch'):
+            self.session.trials.prefetch()
+
+    def align_to_volume(self):
+        """ Sets the duration of the last phase so that the next trial starts with a (predicted) volume. """
+        listener = self.session.trigger_listener
+        last_phase = len(self.phase_durations) - 1
+
+        if (not self.align_to_volumes) or (listener is None) or (self.phase != last_phase - 1) or \
+                ('aligned_volume' in self.parameters):
+            return
 
+        phase_end = self.session.event_ledger.phase_onset + self.phase_durations[self.phase]
+        next_volume = listener.next_volume(phase_end)
 
-        self.parameters['start_marker_position'] = np.random.randint(self.session.settings['slider']['range'][0],
-                                                                     self.session.settings['slider']['range'][1] + 1)
+        if next_volume is not None:
+            volume, onset = next_volume
+            self.phase_durations[last_phase] = onset - phase_end
+            self.parameters['aligned_volume'] = volume
+
+    def check_fixation(self):
+        """ Holds the phase before the stimulus until fixation is stable and flags fixation breaks during the stimulus. """
+        if self.gaze_sampler is None:
+            return
+
+        if self.phase == self.gate_phase:
+            elapsed = self.session.clock.getTime() - self.session.event_ledger.phase_onset
+            frame_period = self.session.frame_timing.frame_period
+
+            # Stopping the phase ends it on the next flip
+            if (elapsed + 1.5 * frame_period >= self.gate_duration) and \
+                    self.gaze_sampler.is_fixating(self.min_fixation_duration):
+                self.parameters['fixation_wait'] = max(elapsed + frame_period - self.gate_duration, 0.0)
+                self.parameters['fixation_timeout'] = False
+                self.stop_phase()
+
+        elif self.phase in self.stimulus_phase:
+            if 'fixation_timeout' not in self.parameters:
+                # Fixation was not stable before the timer ran out
+                self.parameters['fixation_wait'] = self.max_fixation_wait
+                self.parameters['fixation_timeout'] = True
+
+            self.parameters['fixation_broken'] = self.gaze_sampler.broken_since(self.session.event_ledger.phase_onset)
+
+    def update_frame_count(self):
+        """ Ends frame-locked phases right after the flip of their last frame. """
+        if self.phase in self.frame_locked_phases:
+            self.frame_counts[self.phase] += 1
+            self.parameters[f'n_frames_{self.phase_names[self.phase]}'] = self.frame_counts[self.phase]
+
+            if self.frame_counts[self.phase] >= self.frame_locked_phases[self.phase]:
+                self.stop_phase()
 
     def get_events(self):
 
+        self.update_frame_count()
+        self.check_fixation()
+        self.prefetch_next_trial()
+        self.align_to_volume()
+
+        if self.phase == (self.response_phase - 1):
+            self.response_controller.arm(self.parameters['start_marker_position'])
+
+        elif self.phase == self.response_phase:
+            if self.response_controller.track():
+                self.parameters['response_time'] = self.response_controller.response_time
+                self.parameters['response'] = self.response_controller.response
+
+                time_so_far = self.session.clock.getTime() - self.start_trial
+                self.phase_durations[self.feedback_phase] = np.min((self.total_duration - time_so_far, self.phase_durations[self.feedback_phase]))
+                self.stop_phase()
+
         events = super().get_events()
 
     def draw(self):
 
+        if self.phase < self.stimulus_phase[0]:
+            # Needs to happen before anything else is drawn, as it clears the back buffer
+            self.stimulus_buffer.render()
+
         if self.session.win.mouseVisible:
             self.session.win.mouseVisible = False
 
-        if (self.phase == self.feedback_phase) & (not hasattr(self, 'response_onset')):
+        if (self.phase == self.feedback_phase) & (not self.responded):
             self.session.fixation_lines.draw(draw_fixation_cross=False)
         elif self.phase in self.stimulus_phase:
             self.session.fixation_lines.draw(draw_fixation_cross=False)
@@ -105,22 +303,14 @@ class TaskTrial(Trial):
             self.prob_cue.draw()
         elif self.phase in self.stimulus_phase:
 
-            if self.session.settings['task'].get('show_prob_during_payoff'):
-                self.prob_fixation.draw()
-
-            self.stimulus_array.draw()
-
-        elif self.phase == (self.response_phase - 1):
-            response_slider.setMarkerPosition(self.parameters['start_marker_position'])
-            response_slider.show_marker = False
+            self.stimulus_buffer.draw()
 
         elif self.phase == self.response_phase:
-            response_slider.marker.inner_color = self.session.settings['slider'].get('color')
             response_slider.draw()
 
         elif self.phase == self.feedback_phase:
-            if hasattr(self, 'response_onset'):
-                response_slider.marker.inner_color = self.session.settings['slider'].get('feedbackColor')
+            if self.responded:
+                self.response_controller.feedback()
                 response_slider.draw()
             else:
                 self.session.too_late_stimulus.draw()
@@ -154,85 +344,76 @@ class TwoStageTasktrial(TaskTrial):
         self.response_phase2 = 6
         self.feedback_phase2 = 7
 
-        self.parameters['start_marker_position'] = np.random.uniform(self.session.settings['slider']['range'][0],
-                                                                self.session.settings['slider']['range'][1])
-
         self.phase_names = ['fixation1', 'prob_cue', 'stimulus', 'jitter', 'response1', 'feedback1',
                             'response2', 'feedback2', 'iti']
 
+        self.response_controller1 = ResponseController(self.session, self.session.response_slider1, mode=self.input_mode)
+        self.response_controller2 = ResponseController(self.session, self.session.response_slider2, mode=self.input_mode)
+
+    def sample_start_marker_position(self):
+        return self.rng.uniform(self.session.settings['slider']['range'][0],
+                                self.session.settings['slider']['range'][1])
+
+    @property
+    def responded(self):
+        return self.response_controller2.committed
+
 
     def get_events(self):
 
+        self.update_frame_count()
+        self.check_fixation()
+        self.prefetch_next_trial()
+        self.align_to_volume()
 
         response_slider1 = self.session.response_slider1
         response_slider2 = self.session.response_slider2
 
         if self.phase == (self.response_phase1 - 1):
-
-            if (not self.session.mouse.getPressed()[0]) and (self.session.mouse.getPos()[0] != response_slider1.marker.pos[0]):
-                try:
-                    self.session.mouse.setPos((response_slider1.marker.pos[0],0))
-                    self.last_mouse_pos = response_slider1.marker.pos[0]
-                except Exception as e:
-                    print(e)
-
-            self.last_mouse_pos = self.session.mouse.getPos()[0]/self.session.settings['interface']['mouse_multiplier']
+            self.response_controller1.arm(self.parameters['start_marker_position'])
 
         elif self.phase == self.response_phase1:
 
-            if not hasattr(self, 'response_onset1'):
-                current_mouse_pos = self.session.mouse.getPos()[0]/self.session.settings['interface']['mouse_multiplier']
-                marker_position = response_slider1.mouseToMarkerPosition(current_mouse_pos)
-                response_slider1.setMarkerPosition(marker_position)
-                self.last_mouse_pos  = current_mouse_pos
-                response_slider1.show_marker = True
-                
-                if self.session.mouse.getPressed()[0]:
-                    self.response_onset1 = self.session.clock.getTime()
-                    self.parameters['response_time1'] = self.response_onset1 - self.session.global_log.iloc[-1]['onset']
-                    self.parameters['response1'] = response_slider1.marker_position
-
-                    time_so_far = self.session.clock.getTime() - self.start_trial
-                    self.phase_durations[self.feedback_phase1] = np.min((self.total_duration - time_so_far, self.phase_durations[self.feedback_phase1]))
-                    self.phase_durations[self.response_phase2] = np.min((self.total_duration - time_so_far - self.phase_durations[self.feedback_phase1]))
+            if self.response_controller1.track():
+                self.parameters['response_time1'] = self.response_controller1.response_time
+                self.parameters['response1'] = self.response_controller1.response
 
-                    range_length = response_slider1.range_[1] - response_slider1.range_[0]
+                time_so_far = self.session.clock.getTime() - self.start_trial
+                self.phase_durations[self.feedback_phase1] = np.min((self.total_duration - time_so_far, self.phase_durations[self.feedback_phase1]))
+                self.phase_durations[self.response_phase2] = np.min((self.total_duration - time_so_far - self.phase_durations[self.feedback_phase1]))
 
-                    response_slider2.range = (response_slider1.marker_position - response_slider1.width_proportion*range_length/2,
-                                              response_slider1.marker_position + response_slider1.width_proportion*range_length/2)
+                range_length = response_slider1.range_[1] - response_slider1.range_[0]
 
-                    response_slider2.setMarkerPosition(np.random.uniform(response_slider2.range[0], response_slider2.range[1]))
+                response_slider2.range = (response_slider1.marker_position - response_slider1.width_proportion*range_length/2,
+                                          response_slider1.marker_position + response_slider1.width_proportion*range_length/2)
 
+                self.response_controller2.arm(self.rng.uniform(response_slider2.range[0], response_slider2.range[1]))
 
-                    self.stop_phase()
+                self.stop_phase()
 
         elif self.phase == self.response_phase2:
 
-            if not hasattr(self, 'response_onset2'):
-                current_mouse_pos = self.session.mouse.getPos()[0]/self.session.settings['interface']['mouse_multiplier']
-                marker_position = response_slider2.mouseToMarkerPosition(current_mouse_pos)
-                response_slider2.setMarkerPosition(marker_position)
-                self.last_mouse_pos  = current_mouse_pos
-                response_slider2.show_marker = True
-                
-                if self.session.mouse.getPressed()[0]:
-                    self.response_onset2 = self.session.clock.getTime()
-                    self.parameters['response_time2'] = self.response_onset2 - self.session.global_log.iloc[-1]['onset']
-                    self.parameters['response'] = response_slider2.marker_position
+            if self.response_controller2.track():
+                self.parameters['response_time2'] = self.response_controller2.response_time
+                self.parameters['response'] = self.response_controller2.response
 
-                    time_so_far = self.session.clock.getTime() - self.start_trial
-                    self.phase_durations[self.feedback_phase2] = np.min((self.total_duration - time_so_far, self.phase_durations[self.feedback_phase2]))
-                    self.stop_phase()
+                time_so_far = self.session.clock.getTime() - self.start_trial
+                self.phase_durations[self.feedback_phase2] = np.min((self.total_duration - time_so_far, self.phase_durations[self.feedback_phase2]))
+                self.stop_phase()
 
-        Trial.get_events(self)
+        LoggedTrial.get_events(self)
 
 
     def draw(self):
 
+        if self.phase < self.stimulus_phase[0]:
+            # Needs to happen before anything else is drawn, as it clears the back buffer
+            self.stimulus_buffer.render()
+
         if self.session.win.mouseVisible:
             self.session.win.mouseVisible = False
 
-        if (self.phase == self.feedback_phase) & (not hasattr(self, 'response_onset')):
+        if (self.phase == self.feedback_phase) & (not self.responded):
             self.session.fixation_lines.draw(draw_fixation_cross=False)
         elif self.phase in self.stimulus_phase:
             self.session.fixation_lines.draw(draw_fixation_cross=False)
@@ -249,32 +430,22 @@ class TwoStageTasktrial(TaskTrial):
             self.prob_cue.draw()
         elif self.phase in self.stimulus_phase:
 
-            if self.session.settings['task'].get('show_prob_during_payoff'):
-                self.prob_fixation.draw()
-
-            self.stimulus_array.draw()
-
-        elif self.phase == (self.response_phase1 - 1):
-            response_slider1.setMarkerPosition(self.parameters['start_marker_position'])
-            response_slider1.show_marker = False
+            self.stimulus_buffer.draw()
 
         elif self.phase == self.response_phase1:
-            response_slider1.marker.inner_color = self.session.settings['slider'].get('color')
             response_slider1.draw()
 
         elif self.phase == self.feedback_phase1:
-            if hasattr(self, 'response_onset1'):
-                response_slider1.marker.inner_color = self.session.settings['slider'].get('feedbackColor')
+            if self.response_controller1.committed:
+                self.response_controller1.feedback()
                 response_slider1.draw()
-                response_slider2.show_marker = False
             else:
                 self.session.too_late_stimulus.draw()
         elif self.phase == self.response_phase2:
-            response_slider2.marker.inner_color = self.session.settings['slider'].get('color')
             response_slider2.draw()
         elif self.phase == self.feedback_phase2:
-            if hasattr(self, 'response_onset2'):
-                response_slider2.marker.inner_color = self.session.settings['slider'].get('feedbackColor')
+            if self.response_controller2.committed:
+                self.response_controller2.feedback()
                 response_slider2.draw()
             else:
                 self.session.too_late_stimulus.draw()
@@ -305,86 +476,77 @@ class TwoSliderTasktrial(TaskTrial):
         self.response_phase2 = 5
         self.feedback_phase = 6
 
-        self.parameters['start_marker_position'] = np.random.uniform(self.session.settings['slider']['range'][0],
-                                                                self.session.settings['slider']['range'][1])
-
         self.phase_names = ['fixation1', 'prob_cue', 'stimulus', 'jitter', 'response1', 
                             'response2', 'feedback', 'iti'] 
-        
+
+        self.response_controller1 = ResponseController(self.session, self.session.response_slider1, mode=self.input_mode)
+        self.response_controller2 = ResponseController(self.session, self.session.response_slider2, mode=self.input_mode,
+                                                       min_rt=.5)
+
+    def sample_start_marker_position(self):
+        return self.rng.uniform(self.session.settings['slider']['range'][0],
+                                self.session.settings['slider']['range'][1])
+
+    @property
+    def responded(self):
+        return self.response_controller2.committed
+
+
     def get_events(self):
 
-        events = super().get_events()
+        self.update_frame_count()
+        self.check_fixation()
+        self.prefetch_next_trial()
+        self.align_to_volume()
 
         response_slider1 = self.session.response_slider1
         response_slider2 = self.session.response_slider2
 
         if self.phase == (self.response_phase1 - 1):
+            self.response_controller1.arm(self.parameters['start_marker_position'])
+            response_slider2.show_marker = False
 
-            if (not self.session.mouse.getPressed()[0]) and (self.session.mouse.getPos()[0] != response_slider1.marker.pos[0]):
-                try:
-                    self.session.mouse.setPos((response_slider1.marker.pos[0],0))
-                    self.last_mouse_pos = response_slider1.marker.pos[0]
-                except Exception as e:
-                    print(e)
-
-            
         elif self.phase == self.response_phase1:
 
-            response_slider2.show_marker = False
-            response_slider2.marker.inner_color = self.session.settings['slider'].get('color')
-
-            if not hasattr(self, 'response_onset1'):
-                current_mouse_pos = self.session.mouse.getPos()[0]/self.session.settings['interface']['mouse_multiplier']
-                marker_position = response_slider1.mouseToMarkerPosition(current_mouse_pos)
-                response_slider1.setMarkerPosition(marker_position)
-                self.last_mouse_pos  = current_mouse_pos
-                response_slider1.show_marker = True
-                
-                if self.session.mouse.getPressed()[0]:
-                    self.response_onset1 = self.session.clock.getTime()
-                    self.parameters['response_time1'] = self.response_onset1 - self.session.global_log.iloc[-1]['onset']
-                    self.parameters['response1'] = response_slider1.marker_position
-
-                    left_edge = list(response_slider1.bins).index(response_slider1.marker_position)
-                    right_edge = left_edge + 1
-                    response_slider2.range = (response_slider1.bins[left_edge], 
-                                              response_slider1.bins[right_edge])
-
-                    self.phase_durations[self.response_phase2] = -self.session.timer.getTime()
-                    self.stop_phase()
+            if self.response_controller1.track():
+                self.parameters['response_time1'] = self.response_controller1.response_time
+                self.parameters['response1'] = self.response_controller1.response
 
-        elif self.phase == self.response_phase2:
+                left_edge = list(response_slider1.bins).index(response_slider1.marker_position)
+                right_edge = left_edge + 1
+                response_slider2.range = (response_slider1.bins[left_edge], 
+                                          response_slider1.bins[right_edge])
 
-            response_slider2.show_marker = True
+                # The second marker starts where the mouse is
+                self.response_controller2.arm(response_slider2.mouseToMarkerPosition(self.response_controller1.position))
 
-            time_in_phase = self.session.timer.getTime() + self.phase_durations[self.response_phase2]
+                self.phase_durations[self.response_phase2] = -self.session.timer.getTime()
+                self.stop_phase()
 
-            if not hasattr(self, 'response_onset2'):
-                current_mouse_pos = self.session.mouse.getPos()[0]/self.session.settings['interface']['mouse_multiplier']
-                marker_position = response_slider2.mouseToMarkerPosition(current_mouse_pos)
-                response_slider2.setMarkerPosition(marker_position)
-                self.last_mouse_pos  = current_mouse_pos
-                response_slider2.show_marker = True
+        elif self.phase == self.response_phase2:
+
+            if self.response_controller2.track():
+                self.parameters['response_time2'] = self.response_controller2.response_time
+                self.parameters['response'] = self.response_controller2.response
 
-                
-                if (time_in_phase > .5) & self.session.mouse.getPressed()[0]:
-                    self.response_onset2 = self.session.clock.getTime()
-                    self.parameters['response_time2'] = self.response_onset2 - self.session.global_log.iloc[-1]['onset']
-                    self.parameters['response'] = response_slider2.marker_position
-                    self.session.response_slider2.marker.inner_color = self.session.settings['slider'].get('feedbackColor')
+                time_so_far = self.session.clock.getTime() - self.start_trial
+                self.phase_durations[self.feedback_phase] = np.min((self.total_duration - time_so_far, self.phase_durations[self.feedback_phase]))
 
-                    time_so_far = self.session.clock.getTime() - self.start_trial
-                    self.phase_durations[self.feedback_phase] = np.min((self.total_duration - time_so_far, self.phase_durations[self.feedback_phase]))
+                self.stop_phase()
 
-                    self.stop_phase()
+        LoggedTrial.get_events(self)
 
 
     def draw(self):
 
+        if self.phase < self.stimulus_phase[0]:
+            # Needs to happen before anything else is drawn, as it clears the back buffer
+            self.stimulus_buffer.render()
+
         if self.session.win.mouseVisible:
             self.session.win.mouseVisible = False
 
-        if (self.phase == self.feedback_phase) & (not hasattr(self, 'response_onset')):
+        if (self.phase == self.feedback_phase) & (not self.responded):
             self.session.fixation_lines.draw(draw_fixation_cross=False)
         elif self.phase in self.stimulus_phase:
             self.session.fixation_lines.draw(draw_fixation_cross=False)
@@ -398,17 +560,22 @@ class TwoSliderTasktrial(TaskTrial):
             self.prob_cue.draw()
         elif self.phase in self.stimulus_phase:
 
-            if self.session.settings['task'].get('show_prob_during_payoff'):
-                self.prob_fixation.draw()
+            self.stimulus_buffer.draw()
 
-            self.stimulus_array.draw()
+        if self.phase == self.feedback_phase:
+            self.response_controller2.feedback()
 
         if self.phase in [4, 5, 6, 7]:
             self.session.response_slider1.draw()
             self.session.response_slider2.draw()
 
-def main(subject, session, run, slider_type='natural', settings='default', calibrate_eyetracker=False):
+def main(subject, session, run, slider_type='natural', settings='default', calibrate_eyetracker=False, profile=False,
+         seed=None, startup_profiler=None, fixation_check=None):
     from session import WTPSession
+
+    if startup_profiler is not None:
+        startup_profiler.stop_imports()
+
     output_dir, output_str = get_output_dir_str(subject, session, 'estimation_task', run)
     settings_fn, use_eyetracker = get_settings(settings)
 
@@ -416,20 +583,20 @@ def main(subject, session, run, slider_type='natural', settings='default', calib
                           output_dir=output_dir, settings_file=settings_fn, 
                           run=run, eyetracker_on=use_eyetracker,
                           slider_type=slider_type,
-                          calibrate_eyetracker=calibrate_eyetracker)
+                          calibrate_eyetracker=calibrate_eyetracker,
+                          profile=profile,
+                          seed=seed,
+                          startup_profiler=startup_profiler,
+                          fixation_check=fixation_check)
 
     session.create_trials()
-    session.run()
 
-if __name__ == "__main__":
-    argparser = argparse.ArgumentParser()
-    argparser.add_argument('subject', type=str, help='Subject nr')
-    argparser.add_argument('session', type=str, help='Session')
-    argparser.add_argument('run', type=int, help='Run')
-    argparser.add_argument('--settings', type=str, help='Settings label', default='default')
-    argparser.add_argument('--calibrate_eyetracker', action='store_true', dest='calibrate_eyetracker')
-    argparser.add_argument('--slider_type', type=str, default='natural', help='Response bar type', choices=['natural', 'log', 'two-stage', 'two-sliders'])
+    if startup_profiler is not None:
+        startup_profiler.mark('trials created')
+        startup_profiler.report()
 
-    args = argparser.parse_args()
+    session.run()
 
-    main(args.subject, args.session, args.run, settings=args.settings, slider_type=args.slider_type, calibrate_eyetracker=args.calibrate_eyetracker)
\ No newline at end of file
+if __name__ == "__main__":
+    main(args.subject, args.session, args.run, settings=args.settings, slider_type=args.slider_type, calibrate_eyetracker=args.calibrate_eyetracker,
+         profile=args.profile, seed=args.seed, startup_profiler=startup_profiler, fixation_check=args.fixation_check)
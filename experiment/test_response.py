@@ -0,0 +1,175 @@
+""" Relative input with the mouse sampler recording the same mouse (python test_response.py, or pytest). """
+import time
+import numpy as np
+from mouse_sampler import MouseSampler
+from response import ResponseController
+
+
+class Mouse(object):
+    """ Behaves like `psychopy.event.Mouse`: getRel() is relative to the last getPos() or getRel(). """
+
+    def __init__(self):
+        self.pos = np.zeros(2)
+        self.last_pos = np.zeros(2)
+
+    def getPos(self):
+        self.last_pos = self.pos.copy()
+        return self.pos.copy()
+
+    def setPos(self, newPos=(0, 0)):
+        self.pos = np.array(newPos, dtype=float)
+        self.last_pos = self.pos.copy()
+
+    def getRel(self):
+        rel = self.pos - self.last_pos
+        self.last_pos = self.pos.copy()
+        return rel
+
+    def getPressed(self):
+        return [0, 0, 0]
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.start = time.perf_counter()
+
+    def getTime(self):
+        return time.perf_counter() - self.start
+
+
+class WindowHandle(object):
+    """ Dispatches mouse events to the handlers pushed onto it, as pyglet windows do. """
+
+    def __init__(self, mouse):
+        self.mouse = mouse
+        self.handlers = []
+
+    def push_handlers(self, **handlers):
+        self.handlers.append(handlers)
+
+    def remove_handlers(self, **handlers):
+        self.handlers.remove(handlers)
+
+    def move(self, pos):
+        dx, dy = np.array(pos) - self.mouse.pos
+        self.mouse.pos = np.array(pos, dtype=float)
+
+        for handlers in self.handlers:
+            handlers['on_mouse_motion'](pos[0], pos[1], dx, dy)
+
+
+class Window(object):
+
+    def __init__(self, mouse):
+        self.winHandle = WindowHandle(mouse)
+
+
+class Bar(object):
+
+    def __init__(self, width):
+        self.pos = (0.0, 0.0)
+        self.width = width
+
+
+class Slider(object):
+    """ Marker position is the horizontal position on the bar. """
+
+    def __init__(self, width=10.):
+        self.bar = Bar(width)
+        self.marker = None
+        self.marker_position = 0.0
+        self.show_marker = False
+
+    def setMarkerPosition(self, number):
+        self.marker_position = number
+
+    def mouseToMarkerPosition(self, mouse_pos):
+        return mouse_pos
+
+    def markerToMousePosition(self, number):
+        return number
+
+
+class EventLedger(object):
+    phase_onset = 0.0
+
+
+class Session(object):
+
+    def __init__(self):
+        self.settings = {'interface': {'mouse_multiplier': 2.}, 'slider': {}}
+        self.mouse = Mouse()
+        self.win = Window(self.mouse)
+        self.clock = Clock()
+        self.event_ledger = EventLedger()
+        self.mouse_sampler = MouseSampler(self.mouse, self.clock, self.win)
+
+    def get_mouse_pos(self):
+        return self.mouse.getPos()
+
+
+def test_relative_mode_with_mouse_sampler():
+    session = Session()
+    slider = Slider()
+    controller = ResponseController(session, slider, mode='relative')
+
+    session.mouse_sampler.start()
+
+    try:
+        controller.arm(-2.)
+        controller.track()
+
+        # 20 frames in which the cursor moves .2 to the right (the marker .1), in 5 events each
+        for frame in range(20):
+            for event in range(5):
+                session.win.winHandle.move(session.mouse.pos + [.04, 0.])
+            controller.track()
+    finally:
+        session.mouse_sampler.stop()
+
+    assert session.mouse_sampler.n_samples == 100
+    assert np.isclose(session.mouse_sampler.positions[99, 0], 4.)
+    assert np.isclose(slider.marker_position, 0.)
+
+
+def test_relative_mode_is_clipped_to_the_bar():
+    session = Session()
+    slider = Slider()
+    controller = ResponseController(session, slider, mode='relative')
+
+    session.mouse_sampler.start()
+
+    try:
+        controller.arm(4.)
+        controller.track()
+
+        # Moving beyond the end of the bar does not build up
+        for x in [8., 16., 12.]:
+            session.win.winHandle.move([x, 0.])
+            controller.track()
+    finally:
+        session.mouse_sampler.stop()
+
+    assert np.isclose(slider.marker_position, 3.)
+
+
+def test_mouse_sampler_records_button_events():
+    session = Session()
+    sampler = session.mouse_sampler
+    sampler.start()
+
+    sampler._on_press(0, 0, 1, 0)
+    session.win.winHandle.move([1., 0.])
+    sampler._on_release(0, 0, 1, 0)
+    sampler.stop()
+
+    assert list(sampler.pressed[:3]) == [1, 1, 0]
+    assert not session.win.winHandle.handlers
+
+
+if __name__ == '__main__':
+    test_relative_mode_with_mouse_sampler()
+    test_relative_mode_is_clipped_to_the_bar()
+    test_mouse_sampler_records_button_events()
+    print('OK')
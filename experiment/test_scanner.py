@@ -0,0 +1,71 @@
+""" Scanner trigger timestamps from a fake ptb keyboard (python test_scanner.py, or pytest). """
+import numpy as np
+import psychopy.hardware
+from scanner import KeyboardTriggerSource, TriggerListener
+
+# Absolute (Psychtoolbox) times at which PsychoPy's default clock and the session clock were reset
+DEFAULT_CLOCK_RESET = 10.
+SESSION_CLOCK_RESET = 4311.
+
+
+class Clock(object):
+
+    def __init__(self, reset_time):
+        self.reset_time = reset_time
+
+    def getLastResetTime(self):
+        return self.reset_time
+
+
+class KeyPress(object):
+
+    def __init__(self, name, t, clock):
+        # As PsychoPy's ptb keyboard backend makes them
+        self.name = name
+        self.tDown = t - DEFAULT_CLOCK_RESET
+        self.rt = t - clock.getLastResetTime()
+
+
+class Keyboard(object):
+    """ Returns key presses at known absolute times. """
+
+    def __init__(self, clock=None):
+        self.clock = Clock(0.) if clock is None else clock
+        self.times = []
+
+    def getBackend(self):
+        return 'ptb'
+
+    def getKeys(self, keyList=None, waitRelease=True, clear=True):
+        keys = [KeyPress('t', t, self.clock) for t in self.times]
+        self.times = []
+        return keys
+
+
+class KeyboardModule(object):
+    Keyboard = Keyboard
+
+
+def test_keyboard_trigger_onsets_are_in_session_time():
+    clock = Clock(SESSION_CLOCK_RESET)
+    hardware_keyboard = getattr(psychopy.hardware, 'keyboard', None)
+    psychopy.hardware.keyboard = KeyboardModule
+
+    try:
+        source = KeyboardTriggerSource.create('t', clock)
+    finally:
+        psychopy.hardware.keyboard = hardware_keyboard
+
+    assert source.keyboard.clock is clock
+
+    listener = TriggerListener(source, 2.)
+    source.keyboard.times = [SESSION_CLOCK_RESET + 3. + 2. * n for n in range(5)]
+    listener.poll()
+
+    assert np.allclose(listener.volumes['onset'][:listener.n_pulses], [3., 5., 7., 9., 11.])
+    assert listener.next_volume(6.) == (2, 7.)
+
+
+if __name__ == '__main__':
+    test_keyboard_trigger_onsets_are_in_session_time()
+    print('OK')
@@ -0,0 +1,92 @@
+import logging
+import os
+import os.path as op
+import numpy as np
+import pandas as pd
+
+
+class FrameTimingMonitor(object):
+    """ Checks every trial phase for dropped frames and compares its requested and achieved duration.
+
+    Trials report the onset of every phase (from the flip callback that logs
+    it). The flip-to-flip intervals that PsychoPy records while the
+    experiment runs (`win.frameIntervals`) are then assigned to the phase
+    that was on screen, and intervals longer than 1.5 refresh periods
+    count as dropped frames.
+    """
+
+    def __init__(self, win, frame_period=None, threshold=1.5):
+        self.win = win
+
+        if frame_period is None:
+            frame_period = win.monitorFramePeriod
+
+        self.frame_period = frame_period
+        self.threshold = threshold
+        self.phases = []
+        self.current_phase = None
+
+    def phase_started(self, trial, phase, onset):
+        """ Call on the flip that shows the first frame of `phase` of `trial`. """
+        # The interval that ends with the current flip is appended after the flip
+        # callbacks have run, and still belongs to the previous phase
+        first_interval = len(self.win.frameIntervals) + 1
+
+        self._finish_phase(onset, first_interval)
+
+        self.current_phase = {'trial': trial, 'trial_nr': trial.trial_nr, 'phase': phase,
+                              'phase_name': trial.phase_names[phase], 'onset': onset,
+                              'first_interval': first_interval}
+
+    def _finish_phase(self, offset, last_interval):
+        if self.current_phase is None:
+            return
+
+        phase = self.current_phase
+        trial = phase.pop('trial')
+        intervals = np.array(self.win.frameIntervals[phase.pop('first_interval'):last_interval])
+
+        # Phase durations can be changed while the trial runs (e.g., after a response)
+        phase['requested_duration'] = trial.phase_durations[phase['phase']]
+        phase['requested_frames'] = getattr(trial, 'frame_locked_phases', {}).get(phase['phase'], np.nan)
+
+        if not np.isnan(phase['requested_frames']):
+            phase['requested_duration'] = phase['requested_frames'] * self.frame_period
+        phase['achieved_duration'] = offset - phase['onset']
+        phase['n_frames'] = len(intervals)
+        phase['n_dropped_frames'] = int(np.sum(np.round(intervals[intervals > self.threshold * self.frame_period] /
+                                                        self.frame_period) - 1))
+        phase['max_interval'] = intervals.max() if len(intervals) else np.nan
+
+        if phase['n_dropped_frames'] > 0:
+            logging.warning(f"Trial {phase['trial_nr']}, phase {phase['phase_name']}: "
+                            f"{phase['n_dropped_frames']} dropped frame(s) "
+                            f"(longest frame {phase['max_interval'] * 1000:.1f} ms)")
+
+        self.phases.append(phase)
+        self.current_phase = None
+
+    def finish(self, offset):
+        self._finish_phase(offset, len(self.win.frameIntervals))
+
+    def summary(self):
+        columns = ['trial_nr', 'phase', 'phase_name', 'onset', 'requested_duration', 'achieved_duration',
+                   'requested_frames', 'n_frames', 'n_dropped_frames', 'max_interval']
+        summary = pd.DataFrame(self.phases, columns=columns)
+        summary['duration_error'] = summary['achieved_duration'] - summary['requested_duration']
+        return summary.round(5)
+
+    def save(self, output_dir, output_str):
+        if not op.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        summary = self.summary()
+        fn = op.join(output_dir, f'{output_str}_timing.tsv')
+        summary.to_csv(fn, sep='\t', index=False)
+
+        stimulus_phases = summary[summary['phase_name'] == 'stimulus']
+        print(f"Frame timing: {summary['n_dropped_frames'].sum()} dropped frames in {len(summary)} phases, "
+              f"{(stimulus_phases['n_dropped_frames'] > 0).sum()} of {len(stimulus_phases)} stimulus phases affected "
+              f"(refresh period {self.frame_period * 1000:.2f} ms)")
+
+        return fn
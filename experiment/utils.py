@@ -1,119 +1,252 @@
 import numpy as np
-from psychopy.visual import ElementArrayStim, RadialStim, Circle
 import os.path as op
+import sys
 import logging
-from exptools2.core import Trial
 import yaml
-from instruction import InstructionTrial
 
-def _sample_dot_positions(n=10, circle_radius=20, dot_radius=1, min_ecc=0.1, max_n_tries=10000):
+def _close_pairs(x, y, min_dist):
+    """ All pairs of points (earlier, later) that are closer than `min_dist`, found with a sweep along x. """
+    order = np.argsort(x)
+    sx, sy = x[order], y[order]
+    m = len(x)
 
-    coords = np.zeros((0, 2))
+    # The points within min_dist (along x) of a point directly follow it in sorted order
+    ends = np.searchsorted(sx, sx + min_dist)
+    width = (ends - np.arange(m)).max()
+
+    ii = np.repeat(np.arange(m), width - 1).reshape(m, width - 1)
+    jj = ii + np.arange(1, width)
+    in_band = jj < ends[:, np.newaxis]
+    ii, jj = ii[in_band], jj[in_band]
+
+    close = ((sx[jj] - sx[ii])**2 + (sy[jj] - sy[ii])**2) <= min_dist**2
+    a, b = order[ii[close]], order[jj[close]]
+
+    return np.minimum(a, b), np.maximum(a, b)
+
+
+def _sample_dot_positions(n=10, circle_radius=20, dot_radius=1, min_ecc=0.1, max_n_tries=10000,
+                          batch_size=64, rng=None):
+    """ Samples `n` non-overlapping dot positions within a circular aperture.
+
+    Candidates are drawn in batches (of about twice the number of dots that
+    are still missing), so that usually a single batch suffices. The pairs
+    of dots that are too close are found with a sweep along x, and every
+    candidate is accepted if it does not conflict with an earlier accepted
+    dot (resolved in sampling order, as in the original one-at-a-time
+    rejection sampler). The eccentricity distribution and minimal distance
+    (2.2 dot radii) are the same as for that sampler.
+
+    Candidates are drawn from `rng` (a `np.random.Generator`, or a new one
+    if None), so the same generator state always gives the same layout.
+    """
+
+    min_dist = (dot_radius * 2) * 1.1
+    max_ecc = circle_radius - dot_radius
+    min_ecc_frac = min_ecc / circle_radius
+
+    if n == 0:
+        return np.zeros((0, 2))
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    if max_ecc <= 0:
+        raise ValueError(f'Dots of radius {dot_radius} do not fit in an aperture of radius {circle_radius}')
+
+    # Random sequential packing jams at ~55% coverage; beyond that the
+    # sampler can never succeed, so fail early with an informative error.
+    coverage = n * (min_dist / 2.)**2 / (max_ecc + min_dist / 2.)**2
+    if coverage > 0.5:
+        raise ValueError(f'Cannot place {n} dots of radius {dot_radius} in an aperture of radius {circle_radius}: '
+                         f'the dots would cover {coverage:.0%} of the aperture (maximum is 50%)')
+
+    x, y = np.zeros(0), np.zeros(0)
     tries = 0
 
-    while((coords.shape[0] < n) & (tries < max_n_tries)):
-        radius = np.random.rand() * np.pi * 2
-        min_ecc_frac = min_ecc / circle_radius
-        ecc = np.sqrt((np.random.rand() + min_ecc_frac) / (1.+min_ecc_frac))  * (circle_radius - dot_radius)
-        coord = np.array([[np.cos(radius), np.sin(radius)]]) * ecc
+    while (len(x) < n) & (tries < max_n_tries):
+        n_accepted = len(x)
+        size = min(max(batch_size, 2 * (n - n_accepted)), max_n_tries - tries)
+        tries += size
+
+        angle, ecc = rng.random((2, size))
+        angle *= np.pi * 2
+        ecc = np.sqrt((ecc + min_ecc_frac) / (1. + min_ecc_frac)) * max_ecc
 
-        distances = np.sqrt(((coords - coord)**2).sum(1))
+        # The accepted dots come first, followed by the new candidates in the order they were drawn
+        x = np.concatenate((x, np.cos(angle) * ecc))
+        y = np.concatenate((y, np.sin(angle) * ecc))
+        earlier, later = _close_pairs(x, y, min_dist)
 
-        # Make the radius slightly larger
-        if (distances > (dot_radius * 2) * 1.1).all():
-            coords = np.vstack((coords, coord))
+        accepted = np.zeros(len(x), dtype=bool)
+        rejected = np.zeros(len(x), dtype=bool)
 
-        tries += 1
+        if len(earlier) == 0:
+            accepted[:] = True
+        else:
+            accepted[:n_accepted] = True
 
-    if tries == max_n_tries:
-        raise Exception
+        # A candidate is accepted once none of the earlier candidates it conflicts with can still be
+        # accepted, and rejected once one of them is. Every pass decides at least the first open candidate.
+        undecided = ~accepted
+        while undecided.any():
+            blocked = np.zeros(len(x), dtype=bool)
+            blocked[later[~rejected[earlier]]] = True
+            accepted |= undecided & ~blocked
 
-    return coords
+            blocked[:] = False
+            blocked[later[accepted[earlier]]] = True
+            rejected |= undecided & blocked
+
+            undecided = ~(accepted | rejected)
+
+        keep = np.where(accepted)[0][:n]
+        x, y = x[keep], y[keep]
+
+    if len(x) < n:
+        raise RuntimeError(f'Could only place {len(x)} out of {n} dots of radius {dot_radius} in an aperture of '
+                           f'radius {circle_radius} after {max_n_tries} tries')
+
+    return np.stack((x, y), 1)
 
 
 class RadialStimArray(object):
+    """ All dots of a cloud as a single ElementArrayStim, so that drawing costs one draw call. """
+
+    def __init__(self, win, xys, sizes, texRes=128):
+        # Imported here, so that tools that only need the helpers in this module do not load psychopy.visual
+        from psychopy.visual import ElementArrayStim
+
+        self._xys = np.asarray(xys)
+        self.stimulus = ElementArrayStim(win, nElements=len(self._xys), xys=self._xys, sizes=np.asarray(sizes) * 2,
+                                         elementTex=None, elementMask='circle', texRes=texRes,
+                                         colors=[1, 1, 1], colorSpace='rgb')
+
+    @property
+    def xys(self):
+        return self._xys
 
-    def __init__(self, win, xys, sizes):
-        self.stimulus = Circle(win, radius=sizes, edges=128, fillColor=[1, 1, 1])
-        self.xys = xys
+    @xys.setter
+    def xys(self, value):
+        # The number of dots of an ElementArrayStim is fixed
+        value = np.asarray(value)
+        assert value.shape == self._xys.shape
+        self._xys = value
+        self.stimulus.xys = value
 
     def draw(self):
-        for pos in self.xys:
-            self.stimulus.pos = pos
-            self.stimulus.draw()
+        self.stimulus.draw()
 
-def _create_stimulus_array(win, n_dots, circle_radius, dot_radius):
-    xys = _sample_dot_positions(n_dots, circle_radius, dot_radius)
+def _create_stimulus_array(win, n_dots, circle_radius, dot_radius, xys=None, rng=None):
+    if xys is None:
+        xys = _sample_dot_positions(n_dots, circle_radius, dot_radius, rng=rng)
     return RadialStimArray(win, xys, dot_radius)
 
 
-def get_output_dir_str(subject, session, task, run):
-    output_dir = op.join(op.dirname(__file__), 'logs', f'sub-{subject}')
-    logging.warn(f'Writing results to  {output_dir}')
+class StimulusArrayPool(object):
+    """ Reuses RadialStimArrays (one free list per number of dots) instead of creating new ones for every trial. """
 
-    if session:
-        output_dir = op.join(output_dir, f'ses-{session}')
-        output_str = f'sub-{subject}_ses-{session}_task-{task}'
-    else:
-        output_str = f'sub-{subject}_task-{task}'
+    def __init__(self, win, circle_radius, dot_radius):
+        self.win = win
+        self.circle_radius = circle_radius
+        self.dot_radius = dot_radius
+        self.free = {}
+        self.n_created = 0
 
-    if run:
-        output_str += f'_run-{run}'
+    def acquire(self, n_dots, xys=None, rng=None):
+        if xys is None:
+            xys = _sample_dot_positions(n_dots, self.circle_radius, self.dot_radius, rng=rng)
 
-    return output_dir, output_str
+        if self.free.get(n_dots):
+            stimulus_array = self.free[n_dots].pop()
+            stimulus_array.xys = xys
+        else:
+            stimulus_array = _create_stimulus_array(self.win, n_dots, self.circle_radius, self.dot_radius, xys=xys)
+            self.n_created += 1
 
-class DummyWaiterTrial(InstructionTrial):
-    """ Simple trial with text (trial x) and fixation. """
+        return stimulus_array
 
-    def __init__(self, session, trial_nr, phase_durations=None, n_triggers=1,
-                 txt="Waiting for scanner triggers.", **kwargs):
+    def release(self, stimulus_array):
+        self.free.setdefault(len(stimulus_array.xys), []).append(stimulus_array)
 
-        phase_durations = [np.inf] * n_triggers
-        phase_names = [f'trigger_{n+1}' for n in range(n_triggers)]
 
-        super().__init__(session, trial_nr, txt=txt, phase_durations=phase_durations,
-                         bottom_txt='', 
-                         phase_names=phase_names,
-                         **kwargs)
+class LazyTrialSequence(object):
+    """ Trial specifications that are only turned into trials when they are needed.
 
-        self.last_trigger = 0.0
+    Trials can construct their successor ahead of time (e.g., during an ISI)
+    with `prefetch()`. Trials that have been run are not kept around, so
+    their stimuli can be garbage collected.
+    """
 
-    def get_events(self):
-        events = Trial.get_events(self)
+    def __init__(self):
+        self.specs = []
+        self.current_ix = -1
+        self._prefetched = {}
 
-        if events:
-            for key, t in events:
-                if key == self.session.mri_trigger:
-                    if t - self.last_trigger > .5:
-                        self.stop_phase()
-                        self.last_trigger = t
-class OutroTrial(InstructionTrial): 
-    """ Simple trial with only fixation cross.  """
+    def append(self, trial_class, *args, **kwargs):
+        self.specs.append((trial_class, args, kwargs))
 
-    def __init__(self, session, trial_nr=0, phase_durations=None, **kwargs):
+    def append_row(self, trial_class, table, ix, *args):
+        """ A trial whose keyword arguments are the fields of row `ix` of a structured array. """
+        self.specs.append((trial_class, args, table[ix]))
 
-        txt = '''Please lie still for a few moments.'''
+    def __len__(self):
+        return len(self.specs)
 
-        if phase_durations is None:
-            phase_durations = [5*60]
+    def _build(self, ix):
+        trial_class, args, kwargs = self.specs[ix]
 
-        super().__init__(session=session, trial_nr=trial_nr, phase_durations=phase_durations, txt=txt,
-                         bottom_txt='', 
-                         phase_names=['outro'],
-                         **kwargs)
+        if isinstance(kwargs, np.void):
+            kwargs = {key: kwargs[key].item() for key in kwargs.dtype.names}
 
-    def draw(self):
-        self.session.fixation_lines.draw()
-        super().draw()
+        return trial_class(*args, **kwargs)
+
+    def prefetch(self):
+        ix = self.current_ix + 1
+
+        if (ix < len(self.specs)) and (ix not in self._prefetched):
+            self._prefetched[ix] = self._build(ix)
 
-    def get_events(self):
-        events = Trial.get_events(self)
+    def __iter__(self):
+        for ix in range(len(self.specs)):
+            self.current_ix = ix
+            trial = self._prefetched.pop(ix, None)
 
-        if events:
-            for key, t in events:
-                if key == 'space':
-                    self.stop_phase()
+            if trial is None:
+                trial = self._build(ix)
 
+            yield trial
+
+
+def get_peak_memory():
+    """ Peak resident memory of this process in MB (NaN if it cannot be determined). """
+    try:
+        import resource
+    except ImportError:
+        return np.nan
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Reported in bytes on macOS, but in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / 1024**2
+    return peak / 1024
+
+
+def get_output_dir_str(subject, session, task, run):
+    output_dir = op.join(op.dirname(__file__), 'logs', f'sub-{subject}')
+    logging.warn(f'Writing results to  {output_dir}')
+
+    if session:
+        output_dir = op.join(output_dir, f'ses-{session}')
+        output_str = f'sub-{subject}_ses-{session}_task-{task}'
+    else:
+        output_str = f'sub-{subject}_task-{task}'
+
+    if run:
+        output_str += f'_run-{run}'
+
+    return output_dir, output_str
 
 def get_settings(settings):
     settings_fn = op.join(op.dirname(__file__), 'settings', f'{settings}.yml')